@@ -0,0 +1,173 @@
+"""Микробенчмарк маршрутизации нажатий кнопок.
+
+Сравнивает накладные расходы диспетчера на один callback-апдейт:
+- legacy — прежняя схема: цепочка фильтров ``lambda c: c.data...`` в
+  порядке регистрации и handle_error, вызывающий inspect.signature на
+  каждом апдейте;
+- table — текущая: один обработчик route_callback, выборка действия из
+  таблицы CallbackRouter и handle_error с параметрами, разобранными при
+  декорировании.
+
+Обработчики пустые, Bot API не вызывается — измеряется только путь от
+dp.feed_update до обработчика.
+
+Запуск:
+    python bench/callback_routing.py --iterations 20000
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import sys
+import tempfile
+import time
+from functools import wraps
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Прежние данные кнопок и их аналоги в новом формате
+BUTTONS = [
+    ("cancel", "1:cancel"),
+    ("add_link", "1:add"),
+    ("stats", "1:stats"),
+    ("stats_next:1", "1:page:1"),
+    ("link_stats:3", "1:ls:3.a1b2c3"),
+    ("link_stats_live:3", "1:live:3.a1b2c3"),
+    ("delete_link:3", "1:del:3.a1b2c3"),
+    ("rename_link:3", "1:ren:3.a1b2c3"),
+    ("bulk_import", "1:bulk"),
+    ("dashboard", "1:dash"),
+    ("export:csv", "1:export:csv"),
+]
+
+
+def legacy_handle_error(handler):
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        sig = inspect.signature(handler)
+        filtered_kwargs = {k: v for k, v in kwargs.items() if k in sig.parameters}
+        return await handler(*args, **filtered_kwargs)
+    return wrapper
+
+
+def legacy_router(Router):
+    router = Router()
+
+    async def plain(cb, state):
+        return None
+
+    async def with_arg(cb, state):
+        return cb.data.split(":")[1]
+
+    filters = [
+        lambda c: c.data == "cancel",
+        lambda c: c.data == "add_link",
+        lambda c: c.data == "stats",
+        lambda c: c.data.startswith("stats_next:"),
+        lambda c: c.data.startswith("link_stats:"),
+        lambda c: c.data.startswith("link_stats_live:"),
+        lambda c: c.data.startswith("delete_link:"),
+        lambda c: c.data.startswith("rename_link:"),
+        lambda c: c.data == "bulk_import",
+        lambda c: c.data == "dashboard",
+        lambda c: c.data.startswith("export:"),
+    ]
+    for callback_filter, (data, _) in zip(filters, BUTTONS):
+        router.callback_query(callback_filter)(legacy_handle_error(with_arg if ":" in data else plain))
+    return router
+
+
+def table_router(Router, main):
+    router = Router()
+    callbacks = main.CallbackRouter()
+    legacy_names = {code: name for name, code in main.callbacks._legacy.items()}
+
+    async def handler(cb, state, page=None, link=None, fmt=None):
+        return page, link, fmt
+
+    for code, (_, arg_types) in main.callbacks._routes.items():
+        callbacks.action(code, legacy=legacy_names.get(code), **arg_types)(main.handle_error(handler))
+
+    @router.callback_query()
+    async def route_callback(cb, **data):
+        route = callbacks.unpack(cb.data)
+        if route is None:
+            return None
+        handler, args = route
+        return await handler(cb, **data, **args)
+
+    return router
+
+
+def make_update(Update, update_id, data):
+    return Update.model_validate({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": 42, "is_bot": False, "first_name": "bench"},
+            "chat_instance": "42",
+            "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": 42, "type": "private"}, "text": "…"},
+        },
+    })
+
+
+async def measure(router, column, iterations):
+    from aiogram import Bot, Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from aiogram.types import Update
+
+    main = sys.modules["main"]
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(router)
+    bot = Bot(main.BOT_TOKEN)
+    updates = [make_update(Update, i, buttons[column]) for i, buttons in enumerate(BUTTONS)]
+    per_button = {}
+    for update, buttons in zip(updates, BUTTONS):
+        for _ in range(iterations // 10):  # прогрев
+            await dp.feed_update(bot, update)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            await dp.feed_update(bot, update)
+        per_button[buttons[column]] = (time.perf_counter() - started) / iterations
+    await bot.session.close()
+    return per_button
+
+
+async def run(args):
+    os.chdir(tempfile.mkdtemp(prefix="callbench-"))
+    os.environ.setdefault("METRICS_PORT", "0")
+    sys.path.insert(0, str(ROOT))
+    import main
+    from aiogram import Router
+
+    main.logger.remove()
+    legacy = await measure(legacy_router(Router), 0, args.iterations)
+    table = await measure(table_router(Router, main), 1, args.iterations)
+    rows = {
+        new: {
+            "legacy_us": round(legacy[old] * 1e6, 2),
+            "table_us": round(table[new] * 1e6, 2),
+        }
+        for old, new in BUTTONS
+    }
+    mean = lambda values: sum(values) / len(values)
+    return {
+        "iterations": args.iterations,
+        "mean_legacy_us": round(mean(list(legacy.values())) * 1e6, 2),
+        "mean_table_us": round(mean(list(table.values())) * 1e6, 2),
+        "buttons": rows,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5000, help="апдейтов на каждую кнопку")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Локальная заглушка Telegram Bot API.
+
+Отвечает на методы, которые вызывает бот (getMe, getUpdates, setWebhook,
+sendMessage, editMessageText и т. д.), раздаёт апдейты через getUpdates и
+записывает все исходящие вызовы с отметкой времени. Бот направляется сюда
+переменной окружения TELEGRAM_API_URL.
+"""
+import asyncio
+import json
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+# Методы, ответом на которые служит объект Message
+MESSAGE_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup", "sendDocument"}
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.updates = []
+        self.calls = []  # (monotonic_time, method, params)
+        self.counts = Counter()
+        self.webhook_url = None
+        self.polled = asyncio.Event()
+        self.webhook_set = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        self._new_updates = asyncio.Event()
+        self.listeners = []
+
+    def push_update(self, update):
+        """Ставит апдейт в очередь getUpdates, проставляя update_id."""
+        self._update_id += 1
+        update = dict(update, update_id=self._update_id)
+        self.updates.append(update)
+        self._new_updates.set()
+        return update
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [u for u in self.updates if u["update_id"] >= offset]
+
+    def _message(self, params):
+        self._message_id += 1
+        return {
+            "message_id": int(params.get("message_id") or self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == "application/json":
+                params.update(await request.json())
+            else:
+                form = await request.post()
+                params.update({k: v for k, v in form.items() if isinstance(v, str)})
+        now = time.monotonic()
+        self.counts[method] += 1
+        if method != "getUpdates":
+            self.calls.append((now, method, params))
+            for listener in self.listeners:
+                listener(now, method, params)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            self.polled.set()
+            result = await self._get_updates(params)
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_set.set()
+            result = True
+        elif method == "deleteWebhook":
+            self.webhook_url = None
+            result = True
+        elif method in MESSAGE_METHODS:
+            result = self._message(params)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result}, dumps=lambda o: json.dumps(o, ensure_ascii=False))
+
+
+def create_app(fake):
+    app = web.Application()
+    app["fake_telegram"] = fake
+    app.router.add_post("/bot{token}/{method}", fake.handle)
+    return app
+
+
+async def start(host="127.0.0.1", port=8082, fake=None):
+    fake = fake or FakeTelegram()
+    runner = web.AppRunner(create_app(fake))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner, fake
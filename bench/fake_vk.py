@@ -0,0 +1,209 @@
+"""Локальная заглушка VK API для нагрузочных прогонов и ручной проверки.
+
+Поддерживает методы, которые вызывает бот: utils.getShortLink,
+utils.getLinkStats, database.getCountriesById и execute (в том подмножестве
+VKScript, которое генерирует VKBatcher). Задержка ответа и доля ошибок
+настраиваются, счётчики запросов доступны на /_stats. Пути /target/...
+изображают сокращаемые сайты для проверки доступности ссылок (HEAD/GET)
+со своими задержкой и долей ошибок.
+
+Запуск:
+    python bench/fake_vk.py --port 8081 --latency 50 --error-rate 0.01
+    VK_API_URL=http://127.0.0.1:8081/method python main.py
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from collections import Counter
+
+from aiohttp import web
+
+COUNTRIES = {
+    1: "Россия", 2: "Украина", 3: "Беларусь", 4: "Казахстан", 9: "США",
+    65: "Германия", 97: "Польша", 137: "Армения", 138: "Грузия", 139: "Латвия",
+}
+EXECUTE_CALL = re.compile(r"\s*,?\s*API\.([\w.]+)\(")
+
+
+class VKCallError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class FakeVK:
+    def __init__(self, latency=0.0, error_rate=0.0, rps=0, seed=None, target_latency=0.0, target_error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rps = rps
+        self.target_latency = target_latency
+        self.target_error_rate = target_error_rate
+        self.random = random.Random(seed)
+        self.links = {}
+        self.requests = Counter()
+        self.calls = Counter()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    def _rate_limited(self):
+        if not self.rps:
+            return False
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+        return self._window_count > self.rps
+
+    def call(self, method, params):
+        self.calls[method] += 1
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise VKCallError(10, "Internal server error")
+        handler = getattr(self, "m_" + method.replace(".", "_"), None)
+        if handler is None:
+            raise VKCallError(3, f"Unknown method passed: {method}")
+        return handler(params)
+
+    def m_utils_getShortLink(self, params):
+        url = params.get("url")
+        if not url:
+            raise VKCallError(100, "One of the parameters specified was missing or invalid: url is undefined")
+        key = hashlib.sha1(url.encode()).hexdigest()[:6]
+        self.links[key] = url
+        return {"short_url": f"https://vk.cc/{key}", "url": url, "key": key, "access_key": ""}
+
+    def m_utils_getLinkStats(self, params):
+        key = params.get("key")
+        if key not in self.links:
+            raise VKCallError(100, "One of the parameters specified was missing or invalid: key is invalid")
+        rnd = random.Random(key)
+        count = int(params.get("intervals_count", 1))
+        today = int(time.time()) // 86400 * 86400
+        stats = []
+        for i in range(count):
+            countries = [
+                {"country_id": cid, "views": rnd.randint(0, 50)}
+                for cid in rnd.sample(sorted(COUNTRIES), 3)
+            ]
+            stats.append({
+                "timestamp": today - i * 86400,
+                "views": sum(c["views"] for c in countries),
+                "countries": countries,
+            })
+        return {"key": key, "stats": stats}
+
+    def m_database_getCountriesById(self, params):
+        ids = [int(i) for i in str(params.get("country_ids", "")).split(",") if i]
+        return [{"id": i, "title": COUNTRIES.get(i, f"Страна {i}")} for i in ids]
+
+    def m_execute(self, params):
+        results, errors = [], []
+        for method, call_params in parse_execute(params.get("code", "")):
+            try:
+                results.append(self.call(method, call_params))
+            except VKCallError as e:
+                results.append(False)
+                errors.append({"method": method, "error_code": e.code, "error_msg": e.message})
+        return results, errors
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.requests[method] += 1
+        params = dict(request.query)
+        if request.method == "POST":
+            params.update(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not params.get("access_token"):
+            return _error(5, "User authorization failed: no access_token passed.")
+        if self._rate_limited():
+            return _error(6, "Too many requests per second")
+        try:
+            if method == "execute":
+                self.calls[method] += 1
+                results, errors = self.m_execute(params)
+                body = {"response": results}
+                if errors:
+                    body["execute_errors"] = errors
+                return web.json_response(body)
+            return web.json_response({"response": self.call(method, params)})
+        except VKCallError as e:
+            return _error(e.code, e.message)
+
+    async def handle_target(self, request):
+        self.requests["target_" + request.method] += 1
+        if self.target_latency:
+            await asyncio.sleep(self.target_latency)
+        if self.target_error_rate and self.random.random() < self.target_error_rate:
+            return web.Response(status=503)
+        return web.Response(text="ok")
+
+    async def handle_stats(self, request):
+        return web.json_response({"requests": dict(self.requests), "calls": dict(self.calls)})
+
+
+def _error(code, message):
+    return web.json_response({"error": {"error_code": code, "error_msg": message}})
+
+
+def parse_execute(code):
+    """Разбирает код вида ``return [API.a({...}),API.b({...})];``."""
+    code = code.strip()
+    if not (code.startswith("return [") and code.endswith("];")):
+        raise VKCallError(12, "Unable to compile code")
+    body = code[len("return ["):-2]
+    decoder = json.JSONDecoder()
+    calls, pos = [], 0
+    while pos < len(body):
+        match = EXECUTE_CALL.match(body, pos)
+        if not match:
+            raise VKCallError(12, "Unable to compile code")
+        params, pos = decoder.raw_decode(body, match.end())
+        if body[pos:pos + 1] != ")":
+            raise VKCallError(12, "Unable to compile code")
+        calls.append((match.group(1), params))
+        pos += 1
+    return calls
+
+
+def create_app(fake=None):
+    fake = fake or FakeVK()
+    app = web.Application()
+    app["fake_vk"] = fake
+    app.router.add_route("*", "/method/{method}", fake.handle)
+    app.router.add_get("/_stats", fake.handle_stats)
+    app.router.add_route("*", "/target/{tail:.*}", fake.handle_target)
+    return app
+
+
+async def start(host="127.0.0.1", port=8081, fake=None):
+    runner = web.AppRunner(create_app(fake))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0, help="задержка ответа, мс")
+    parser.add_argument("--error-rate", type=float, default=0, help="доля вызовов, завершающихся ошибкой")
+    parser.add_argument("--rps", type=int, default=0, help="лимит запросов в секунду (ошибка 6), 0 — без лимита")
+    parser.add_argument("--target-latency", type=float, default=0, help="задержка ответа /target/..., мс")
+    parser.add_argument("--target-error-rate", type=float, default=0, help="доля ответов 503 на /target/...")
+    args = parser.parse_args()
+    fake = FakeVK(
+        latency=args.latency / 1000, error_rate=args.error_rate, rps=args.rps,
+        target_latency=args.target_latency / 1000, target_error_rate=args.target_error_rate,
+    )
+    web.run_app(create_app(fake), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
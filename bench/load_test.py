@@ -0,0 +1,356 @@
+"""Воспроизводимый нагрузочный прогон диспетчера бота.
+
+Скрипт генерирует (или читает из файла) сценарии для N пользователей:
+/start, add_link → URL → название, список статистики с пагинацией,
+link_stats, переименование и удаление ссылки — и подаёт апдейты прямо в
+dp.feed_update. Bot API подменён сессией-заглушкой в процессе, VK API и
+проверяемые сайты — локальная заглушка fake_vk (пути /target/...) с
+настраиваемыми задержкой и долей ошибок.
+
+Результат — JSON: пропускная способность, p50/p95/p99 по обработчикам,
+число запросов к VK и усиление записи хранилища (записей файла и байт
+на одно изменение данных).
+
+Запуск:
+    python bench/load_test.py --users 200 --links 12 --seed 1
+    python bench/load_test.py --record scenario.jsonl --users 50
+    python bench/load_test.py --replay scenario.jsonl --vk-latency 80 --output baseline.json
+    python bench/load_test.py --main-middlewares --telegram-latency 50
+
+По умолчанию апдейты пользователя подаются строго по одному. С
+--main-middlewares регистрируются те же outer-middleware, что в main(), и
+замеряется параллельная обработка, как у бота в проде.
+
+В файле сценария по одному событию (JSON) в строке:
+    {"user": 10001, "kind": "message", "text": "/start"}
+    {"user": 10001, "kind": "callback", "data": "1:add"}
+Подстрока {target} в тексте заменяется на адрес заглушки сайтов.
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from aiogram.client.session.base import BaseSession
+
+import fake_vk
+from fake_telegram import BOT_USER, MESSAGE_METHODS
+from webhook_latency import percentile
+
+ROOT = Path(__file__).resolve().parent.parent
+PERCENTILES = (50, 95, 99)
+
+
+class MockSession(BaseSession):
+    """Сессия Bot API без сети: отвечает правдоподобными объектами и считает вызовы."""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    def _result(self, method):
+        if method.__api_method__ not in MESSAGE_METHODS:
+            return True
+        chat_id = getattr(method, "chat_id", None) or 0
+        return {
+            "message_id": getattr(method, "message_id", None) or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            "text": getattr(method, "text", None) or "",
+        }
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = json.dumps({"ok": True, "result": self._result(method)})
+        return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def generate_scenario(users, links, shared_ratio, seed):
+    """Сценарии пользователей; часть URL общая, чтобы работал индекс сокращённых ссылок."""
+    rnd = random.Random(seed)
+    events = []
+    for n in range(users):
+        uid = 10_000 + n
+        events.append({"user": uid, "kind": "message", "text": "/start"})
+        for j in range(links):
+            if rnd.random() < shared_ratio:
+                url = f"{{target}}/shared/{rnd.randrange(max(1, users * links // 10))}"
+            else:
+                url = f"{{target}}/u{uid}/l{j}?utm_source=bench"
+            events += [
+                {"user": uid, "kind": "callback", "data": "1:add"},
+                {"user": uid, "kind": "message", "text": url},
+                {"user": uid, "kind": "message", "text": f"Ссылка {j}"},
+            ]
+        events.append({"user": uid, "kind": "callback", "data": "1:stats"})
+        if links > 10:
+            events.append({"user": uid, "kind": "callback", "data": "1:page:1"})
+        events += [
+            {"user": uid, "kind": "callback", "data": "1:ls:0"},
+            {"user": uid, "kind": "callback", "data": "1:ren:0"},
+            {"user": uid, "kind": "message", "text": "Новое название"},
+            {"user": uid, "kind": "callback", "data": "1:del:0"},
+        ]
+    return events
+
+
+def load_scenario(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_scenario(path, events):
+    with open(path, "w", encoding="utf-8") as f:
+        for event in events:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def build_update(event, update_id, target):
+    uid = event["user"]
+    user = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+    chat = {"id": uid, "type": "private"}
+    if event["kind"] == "callback":
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": user,
+                "chat_instance": str(uid),
+                "data": event["data"],
+                "message": {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": "…"},
+            },
+        }
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": user,
+            "text": event["text"].replace("{target}", target),
+        },
+    }
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.mean(values) * 1000, 3),
+        **{f"p{q}_ms": round(percentile(values, q) * 1000, 3) for q in PERCENTILES},
+    }
+
+
+def file_size(*paths):
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+async def run(args):
+    events = load_scenario(args.replay) if args.replay else generate_scenario(
+        args.users, args.links, args.shared_ratio, args.seed
+    )
+    if args.record:
+        save_scenario(args.record, events)
+
+    fake = fake_vk.FakeVK(
+        latency=args.vk_latency / 1000, error_rate=args.vk_error_rate, seed=args.seed,
+        target_latency=args.target_latency / 1000, target_error_rate=args.target_error_rate,
+    )
+    vk_runner = await fake_vk.start(port=0, fake=fake)
+    port = vk_runner.addresses[0][1]
+
+    # Конфигурация main.py читается при импорте — окружение готовим заранее
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.chdir(workdir)
+    os.environ.update(
+        VK_API_URL=f"http://127.0.0.1:{port}/method",
+        VK_RPS=str(args.vk_rps),
+        VK_BURST=str(max(1, int(args.vk_rps))),
+        STORAGE_BACKEND=args.storage,
+        LINKS_FILE=os.path.join(workdir, "links.json"),
+        LINKS_DB=os.path.join(workdir, "links.db"),
+        SHORT_INDEX_DB=os.path.join(workdir, "shortlinks.db"),
+        COUNTRIES_FILE=os.path.join(workdir, "countries.json"),
+        STATS_HISTORY_FILE=os.path.join(workdir, "stats_history.json"),
+    )
+    # Сценарий нажимает кнопки быстрее человека — защита от флуда исказила бы замер
+    os.environ.setdefault("FLOOD_CONTROL", "0")
+    sys.path.insert(0, str(ROOT))
+    import main
+    from aiogram import Bot, Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    import aiohttp
+
+    if not args.verbose:
+        main.logger.remove()
+
+    handler_times = defaultdict(list)
+
+    async def record_handler(handler, event, data):
+        name = main.handler_name(event, data)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_times[name].append(time.perf_counter() - started)
+
+    main.router.message.middleware(record_handler)
+    main.router.callback_query.middleware(record_handler)
+
+    session = MockSession(latency=args.telegram_latency / 1000)
+    if args.outbound:
+        # Темп отправки, как у настоящего бота: лимиты Telegram на бота и на чат
+        session.middleware(main.outbound_scheduler)
+    bot = Bot(main.BOT_TOKEN, session=session)
+    main.bot = bot  # уведомления вне обработчиков идут через глобальный bot
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(main.router)
+    user_ordering = None
+    if args.main_middlewares:
+        # Тот же конвейер, что в main(): отсечение повторных нажатий и параллельная
+        # обработка с порядком внутри пользователя — feed_raw_update возвращается сразу
+        dp.update.outer_middleware(main.flood_control.coalesce)
+        if main.UPDATE_CONCURRENCY > 1:
+            user_ordering = main.UserOrderingMiddleware()
+            dp.update.outer_middleware(user_ordering)
+    update_times = []
+    failed = 0
+
+    async def record_update(handler, event, data):
+        # Регистрируется последним: время от подачи апдейта до конца обработки,
+        # включая ожидание в очереди пользователя
+        nonlocal failed
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed += 1
+            raise
+        finally:
+            update_times.append(time.perf_counter() - data["bench_started"])
+
+    dp.update.outer_middleware(record_update)
+    main.storage.start()
+
+    by_user = defaultdict(list)
+    for event in events:
+        by_user[event["user"]].append(event)
+    update_ids = itertools.count(1)
+    target = f"http://127.0.0.1:{port}/target"
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(user_events):
+        async with limit:
+            for event in user_events:
+                update = build_update(event, next(update_ids), target)
+                try:
+                    await dp.feed_raw_update(bot, update, bench_started=time.perf_counter())
+                except Exception:
+                    pass  # учтено в record_update
+
+    async with aiohttp.ClientSession() as vk_session:
+        dp.update.middleware(main.VKSessionMiddleware(vk_session))
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(user_events) for user_events in by_user.values()))
+        if user_ordering is not None:
+            await user_ordering.drain()
+        elapsed = time.perf_counter() - started
+
+    await main.storage.close()
+    main.short_index.close()
+    await main.url_prober.close()
+    await vk_runner.cleanup()
+
+    mutations = main.metrics.value("bot_storage_mutations_total")
+    writes = main.metrics.value("bot_storage_writes_total")
+    written = main.metrics.value("bot_storage_write_bytes_total")
+    report = {
+        "config": {
+            "users": len(by_user), "updates": len(events), "concurrency": args.concurrency,
+            "storage": args.storage, "seed": args.seed, "scenario": args.replay or "generated",
+            "vk_latency_ms": args.vk_latency, "vk_error_rate": args.vk_error_rate, "vk_rps": args.vk_rps,
+            "target_latency_ms": args.target_latency, "target_error_rate": args.target_error_rate,
+            "telegram_latency_ms": args.telegram_latency, "outbound_scheduler": args.outbound,
+            "main_middlewares": args.main_middlewares,
+            "update_concurrency": main.UPDATE_CONCURRENCY if args.main_middlewares else 1,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(update_times) / elapsed, 1) if elapsed else None,
+        "failed_updates": failed,
+        "update_latency": summarize(update_times) if update_times else None,
+        "handlers": {name: summarize(times) for name, times in sorted(handler_times.items())},
+        "vk": {"http_requests": dict(fake.requests), "api_calls": dict(fake.calls)},
+        "telegram_calls": dict(session.calls),
+        "storage": {
+            "mutations": mutations,
+            "file_writes": writes,
+            "bytes_written": written,
+            "writes_per_mutation": round(writes / mutations, 3) if mutations else None,
+            "bytes_per_mutation": round(written / mutations, 1) if mutations else None,
+            "final_size_bytes": file_size(
+                main.LINKS_FILE if args.storage == "json" else main.LINKS_DB,
+                *(() if args.storage == "json" else (f"{main.LINKS_DB}-wal",)),
+            ),
+        },
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="число синтетических пользователей")
+    parser.add_argument("--links", type=int, default=12, help="ссылок на пользователя (больше 10 — с пагинацией)")
+    parser.add_argument("--shared-ratio", type=float, default=0.2, help="доля URL, общих для разных пользователей")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="сохранить сценарий в файл (JSON Lines)")
+    parser.add_argument("--replay", help="взять сценарий из файла вместо генерации")
+    parser.add_argument("--concurrency", type=int, default=50, help="пользователей, обслуживаемых одновременно")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--vk-latency", type=float, default=20, help="задержка VK API, мс")
+    parser.add_argument("--vk-error-rate", type=float, default=0, help="доля вызовов VK с ошибкой")
+    parser.add_argument("--vk-rps", type=float, default=1000, help="лимит VK_RPS планировщика")
+    parser.add_argument("--target-latency", type=float, default=10, help="задержка проверяемых сайтов, мс")
+    parser.add_argument("--target-error-rate", type=float, default=0, help="доля ответов 503 от сайтов")
+    parser.add_argument("--telegram-latency", type=float, default=0, help="задержка заглушки Bot API, мс")
+    parser.add_argument("--outbound", action="store_true", help="пропускать ответы через очередь исходящих с лимитами Telegram")
+    parser.add_argument(
+        "--main-middlewares", action="store_true",
+        help="outer-middleware как в main(): coalesce и параллельная обработка (UPDATE_CONCURRENCY)"
+    )
+    parser.add_argument("--output", help="куда записать отчёт (JSON)")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    for name in ("record", "replay"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    # Отладочный вывод бота уходит в stderr, в stdout — только отчёт
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Проверка порядка апдейтов пользователя при параллельной обработке.
+
+Подаёт через dp.update.outer_middleware(UserOrderingMiddleware()) цепочки
+«нажатие add_link → URL → название» без пауз между апдейтами: Bot API
+отвечает с задержкой, поэтому следующий апдейт приходит, пока предыдущий
+ещё работает; пользователи подают апдейты одновременно. Каждый апдейт
+должен попасть в свой обработчик — так же, как при последовательной
+обработке. Код выхода 1, если это не так.
+
+Запуск:
+    python bench/ordering_check.py --telegram-latency 50 --users 20 --links 5
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+
+import fake_vk
+from load_test import MockSession, build_update
+
+ROOT = Path(__file__).resolve().parent.parent
+EXPECTED = ["add_link", "process_link", "process_title"]
+
+
+async def run(args):
+    vk_runner = await fake_vk.start(port=0, fake=fake_vk.FakeVK())
+    port = vk_runner.addresses[0][1]
+    workdir = tempfile.mkdtemp(prefix="ordering-")
+    os.chdir(workdir)
+    os.environ.update(
+        VK_API_URL=f"http://127.0.0.1:{port}/method",
+        LINKS_FILE=os.path.join(workdir, "links.json"),
+        SHORT_INDEX_DB=os.path.join(workdir, "shortlinks.db"),
+        METRICS_PORT="0",
+        FLOOD_CONTROL="0",
+    )
+    sys.path.insert(0, str(ROOT))
+    import main
+    from aiogram import Bot, Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    import aiohttp
+
+    main.logger.remove()
+    handled = defaultdict(list)
+
+    async def record_handler(handler, event, data):
+        handled[event.from_user.id].append(main.handler_name(event, data))
+        return await handler(event, data)
+
+    main.router.message.middleware(record_handler)
+    main.router.callback_query.middleware(record_handler)
+
+    bot = Bot(main.BOT_TOKEN, session=MockSession(latency=args.telegram_latency / 1000))
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(main.router)
+    user_ordering = main.UserOrderingMiddleware()
+    dp.update.outer_middleware(user_ordering)
+    main.storage.start()
+
+    target = f"http://127.0.0.1:{port}/target"
+    update_ids = itertools.count(1)
+    async with aiohttp.ClientSession() as vk_session:
+        dp.update.middleware(main.VKSessionMiddleware(vk_session))
+        async def feed_user(uid):
+            for j in range(args.links):
+                for event in (
+                    {"user": uid, "kind": "callback", "data": "1:add"},
+                    {"user": uid, "kind": "message", "text": f"{{target}}/u{uid}/l{j}"},
+                    {"user": uid, "kind": "message", "text": f"Ссылка {j}"},
+                ):
+                    # Outer-middleware возвращает управление сразу, пока в пуле есть место
+                    await dp.feed_raw_update(bot, build_update(event, next(update_ids), target))
+
+        # Пользователи подают апдейты одновременно, как webhook: пул заполняется,
+        # и апдейты ждут в нём места уже после чтения состояния FSM
+        await asyncio.gather(*(feed_user(10_000 + n) for n in range(args.users)))
+        await user_ordering.drain()
+
+    await main.storage.close()
+    main.short_index.close()
+    await main.url_prober.close()
+    await vk_runner.cleanup()
+
+    broken = {uid: names for uid, names in handled.items() if names != EXPECTED * args.links}
+    return {"users": args.users, "ok": args.users - len(broken), "broken": broken}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--links", type=int, default=5, help="цепочек add_link на пользователя")
+    parser.add_argument("--telegram-latency", type=float, default=50, help="задержка заглушки Bot API, мс")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    sys.exit(1 if report["broken"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Сравнение сквозной задержки webhook и long polling.
+
+Скрипт поднимает заглушки Telegram Bot API и VK, запускает main.py
+отдельным процессом в нужном режиме и подаёт ему одни и те же апдейты:
+в режиме webhook — POST-запросами на эндпоинт бота, в режиме polling —
+через getUpdates заглушки. Задержка апдейта — время от подачи до первого
+исходящего вызова бота в тот же чат.
+
+Запуск:
+    python bench/webhook_latency.py --mode both --users 50
+    python bench/webhook_latency.py --mode webhook --updates recorded.jsonl
+
+Файл --updates содержит по одному апдейту Telegram (JSON) в строке;
+без него используются синтетические /start от разных пользователей.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+
+import aiohttp
+
+import fake_telegram
+import fake_vk
+
+ROOT = Path(__file__).resolve().parent.parent
+SECRET = "bench-secret"
+
+
+def synthetic_updates(users):
+    return [
+        {
+            "message": {
+                "message_id": i + 1,
+                "date": int(time.time()),
+                "chat": {"id": 1000 + i, "type": "private"},
+                "from": {"id": 1000 + i, "is_bot": False, "first_name": f"user{i}"},
+                "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            }
+        }
+        for i in range(users)
+    ]
+
+
+def load_updates(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def chat_of(update):
+    for kind in ("message", "edited_message"):
+        if kind in update:
+            return update[kind]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return None
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def run_mode(mode, updates, args):
+    fake_tg = fake_telegram.FakeTelegram()
+    tg_runner, _ = await fake_telegram.start(port=args.telegram_port, fake=fake_tg)
+    vk_runner = await fake_vk.start(port=args.vk_port)
+    sent = defaultdict(deque)
+    latencies = []
+    done = asyncio.Event()
+
+    def on_call(now, method, params):
+        chat_id = params.get("chat_id")
+        if chat_id is None:
+            return
+        pending = sent.get(int(chat_id))
+        if pending:
+            latencies.append(now - pending.popleft())
+            if len(latencies) == len(updates):
+                done.set()
+
+    fake_tg.listeners.append(on_call)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    env = dict(
+        os.environ,
+        RUN_MODE=mode,
+        TELEGRAM_API_URL=f"http://127.0.0.1:{args.telegram_port}",
+        VK_API_URL=f"http://127.0.0.1:{args.vk_port}/method",
+        WEBHOOK_BASE_URL=f"http://127.0.0.1:{args.webhook_port}",
+        WEBHOOK_PORT=str(args.webhook_port),
+        WEBHOOK_HOST="127.0.0.1",
+        WEBHOOK_SECRET=SECRET,
+        LINKS_FILE=os.path.join(workdir, "links.json"),
+        COUNTRIES_FILE=os.path.join(workdir, "countries.json"),
+    )
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, str(ROOT / "main.py"), cwd=workdir, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        ready = fake_tg.webhook_set if mode == "webhook" else fake_tg.polled
+        await asyncio.wait_for(ready.wait(), args.startup_timeout)
+        started = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            for update_id, update in enumerate(updates, 1):
+                chat_id = chat_of(update)
+                if mode == "webhook":
+                    update = dict(update, update_id=update_id)
+                    sent[chat_id].append(time.monotonic())
+                    async with session.post(
+                        fake_tg.webhook_url, json=update,
+                        headers={"X-Telegram-Bot-Api-Secret-Token": SECRET},
+                    ) as resp:
+                        resp.raise_for_status()
+                else:
+                    sent[chat_id].append(time.monotonic())
+                    fake_tg.push_update(update)
+                if args.interval:
+                    await asyncio.sleep(args.interval)
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.monotonic() - started
+    finally:
+        proc.terminate()
+        await proc.wait()
+        await tg_runner.cleanup()
+        await vk_runner.cleanup()
+    return {
+        "mode": mode,
+        "updates": len(updates),
+        "answered": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies) * 1000, 2) if latencies else None,
+            **{f"p{q}": round(percentile(latencies, q) * 1000, 2) if latencies else None for q in (50, 95, 99)},
+        },
+    }
+
+
+async def run(args):
+    updates = load_updates(args.updates) if args.updates else synthetic_updates(args.users)
+    modes = ["webhook", "polling"] if args.mode == "both" else [args.mode]
+    return [await run_mode(mode, updates, args) for mode in modes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("webhook", "polling", "both"), default="both")
+    parser.add_argument("--users", type=int, default=50, help="число синтетических апдейтов /start")
+    parser.add_argument("--updates", help="файл с записанными апдейтами (JSON Lines)")
+    parser.add_argument("--interval", type=float, default=0.01, help="пауза между апдейтами, с")
+    parser.add_argument("--timeout", type=float, default=30, help="сколько ждать ответов, с")
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--telegram-port", type=int, default=8082)
+    parser.add_argument("--vk-port", type=int, default=8081)
+    parser.add_argument("--webhook-port", type=int, default=8083)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
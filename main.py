@@ -3,23 +3,49 @@ import asyncio
 import json
 import re
 from datetime import datetime
-from urllib.parse import quote, urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode
 from loguru import logger
 import aiohttp
 from aiogram import Bot, Dispatcher, types, Router
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import EditMessageText, DeleteMessage, SendChatAction
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 import inspect
 from functools import wraps
+from contextlib import contextmanager
 import threading
-from typing import Callable, Dict, Any, Awaitable
+import time
+import heapq
+import contextvars
+import bisect
+import itertools
+import random
+import secrets
+import signal
+import sys
+import tempfile
+from collections import OrderedDict
+import sqlite3
+import csv
+import io
+import html
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Awaitable, NamedTuple
 
 # Настройка логгера
-logger.add("bot.log", rotation="1 MB", encoding="utf-8")
+# У каждого воркера шарда свой лог: ротация одного файла из нескольких процессов небезопасна
+logger.add(f"bot.shard{os.environ['SHARD_INDEX']}.log" if os.getenv("SHARD_INDEX") else "bot.log", rotation="1 MB", encoding="utf-8")
 logger.info(f"🚀 Бот запускается в {datetime.now().strftime('%I:%M %p %Z, %d %B %Y')}")
 
 # Токены (оставлены в коде, как указано)
@@ -30,14 +56,711 @@ if not BOT_TOKEN or not VK_TOKEN:
     logger.error("Токены не установлены")
     raise ValueError("BOT_TOKEN и VK_TOKEN должны быть установлены")
 
+# Настройки VK API
+VK_API_URL = os.getenv("VK_API_URL", "https://api.vk.com/method")
+VK_API_VERSION = "5.199"
+# Окно накопления вызовов для execute (с) и размер пакета (VK допускает до 25)
+VK_BATCH_WINDOW = float(os.getenv("VK_BATCH_WINDOW", "0.05"))
+VK_BATCH_SIZE = max(1, min(int(os.getenv("VK_BATCH_SIZE", "25")), 25))
+# Квота токена: запросов в секунду (> 0: на неё делится ожидание токена) и допустимый всплеск
+VK_RPS = max(0.01, float(os.getenv("VK_RPS", "3")))
+VK_BURST = max(1, int(os.getenv("VK_BURST", "3")))
+# Повторы при ошибке 6 / HTTP 429: число попыток и базовая задержка (с)
+VK_MAX_RETRIES = int(os.getenv("VK_MAX_RETRIES", "4"))
+VK_BACKOFF_BASE = float(os.getenv("VK_BACKOFF_BASE", "0.5"))
+VK_STATS_LOG_INTERVAL = float(os.getenv("VK_STATS_LOG_INTERVAL", "60"))
+VK_TOO_MANY_REQUESTS = 6
+# Приоритеты запросов к VK: сокращение ссылок важнее статистики,
+# статистика важнее фоновых задач
+VK_PRIORITY_INTERACTIVE = 0
+VK_PRIORITY_STATS = 1
+VK_PRIORITY_BACKGROUND = 2
+VK_PRIORITIES = (VK_PRIORITY_INTERACTIVE, VK_PRIORITY_STATS, VK_PRIORITY_BACKGROUND)
+
 # Блокировка для JSON
 json_lock = threading.Lock()
 
+def env_flag(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def parse_flood_limits(value):
+    """"handler=rate/burst,..." -> {handler: (rate, burst)}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, limit = item.partition("=")
+        rate, _, burst = limit.partition("/")
+        limits[name.strip()] = (float(rate), max(1, int(burst or 1)))
+    return limits
+
+# Режим получения апдейтов: polling или webhook
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+# Публичный адрес бота (https://example.com), к нему добавляется WEBHOOK_PATH
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; если пуст — генерируется при запуске
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+# Альтернативный адрес Bot API (локальный сервер или заглушка для замеров)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# HTTP-эндпоинт метрик Prometheus (0 — выключен)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Исходящие запросы к Bot API: общий лимит Telegram (~30 сообщений в секунду)
+# и лимит на чат (~1 в секунду, с небольшим запасом на всплески); частоты > 0 —
+# на них делится ожидание токена
+OUTBOUND_RATE = max(0.01, float(os.getenv("OUTBOUND_RATE", "30")))
+OUTBOUND_BURST = max(1, int(os.getenv("OUTBOUND_BURST", "30")))
+OUTBOUND_CHAT_RATE = max(0.01, float(os.getenv("OUTBOUND_CHAT_RATE", "1")))
+OUTBOUND_CHAT_BURST = max(1, int(os.getenv("OUTBOUND_CHAT_BURST", "3")))
+OUTBOUND_MAX_RETRIES = max(0, int(os.getenv("OUTBOUND_MAX_RETRIES", "3")))
+# Приоритеты исходящих сообщений: меньше — важнее
+OUTBOUND_PRIORITY_INTERACTIVE = 0
+OUTBOUND_PRIORITY_BACKGROUND = 1
+OUTBOUND_PRIORITIES = (OUTBOUND_PRIORITY_INTERACTIVE, OUTBOUND_PRIORITY_BACKGROUND)
+
+# Сколько апдейтов обрабатывать одновременно (1 — строго последовательно)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+
+# Шардирование по user_id: при SHARD_COUNT > 1 процесс становится входным,
+# запускает SHARD_COUNT воркеров и пересылает им апдейты по локальным сокетам.
+# SHARD_INDEX входной процесс выставляет воркерам сам.
+SHARD_COUNT = max(1, int(os.getenv("SHARD_COUNT", "1")))
+SHARD_INDEX = int(os.environ["SHARD_INDEX"]) if os.getenv("SHARD_INDEX") else None
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR") or os.path.join(tempfile.gettempdir(), f"kara_boy-shards-{os.getpid()}")
+SHARD_CONNECT_TIMEOUT = float(os.getenv("SHARD_CONNECT_TIMEOUT", "30"))
+# Сколько апдейтов копить для недоступного шарда, пока его воркер перезапускается
+SHARD_BUFFER_SIZE = int(os.getenv("SHARD_BUFFER_SIZE", "1000"))
+
+# Защита от флуда: корзина токенов на пользователя и обработчик —
+# пополнение (в секунду) и ёмкость; FLOOD_LIMITS переопределяет их для
+# отдельных обработчиков: "show_dashboard=0.1/2,export_links=0.05/1"
+FLOOD_CONTROL = env_flag("FLOOD_CONTROL", True)
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))
+FLOOD_BURST = max(1, int(os.getenv("FLOOD_BURST", "5")))
+FLOOD_DEFAULT_LIMITS = {
+    # Обработчики, которые ходят в VK. show_link_stats обычно читает локальную
+    # историю, а повторные нажатия на одну ссылку и так схлопываются
+    "refresh_link_stats": (0.2, 2),
+    "show_dashboard": (0.1, 2),
+    "export_links": (0.05, 2),
+    "cmd_export": (0.05, 2),
+    "process_bulk": (0.05, 2),
+}
+FLOOD_LIMITS = {**FLOOD_DEFAULT_LIMITS, **parse_flood_limits(os.getenv("FLOOD_LIMITS", ""))}
+# Сколько держать отметку «нажатие обрабатывается», если обработчик так и не запустился
+FLOOD_INFLIGHT_TTL = float(os.getenv("FLOOD_INFLIGHT_TTL", "30"))
+
+# Настройки хранилища
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # json или sqlite
+LINKS_FILE = os.getenv("LINKS_FILE", "links.json")
+LINKS_DB = os.getenv("LINKS_DB", "links.db")
+MAX_LINKS_PER_USER = 50
+# Окно надёжности отложенной записи links.json в секундах (0 — писать сразу)
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "2"))
+
+# Массовый импорт: параллельность, лимиты и частота обновления прогресса (с)
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "5"))
+# Больше MAX_LINKS_PER_USER строк не сохранить: лишние вытеснили бы только что импортированные
+BULK_MAX_ROWS = min(int(os.getenv("BULK_MAX_ROWS", "200")), MAX_LINKS_PER_USER)
+BULK_MAX_FILE_SIZE = 1024 * 1024
+BULK_PROGRESS_INTERVAL = float(os.getenv("BULK_PROGRESS_INTERVAL", "1"))
+BULK_SUMMARY_LINES = 15
+# Экспорт: сколько запросов статистики выполнять одновременно
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "10"))
+EXPORT_FORMATS = ("csv", "json")
+# Сводка: параллельность запросов, бюджет ожидания VK (с) и размер топов
+DASHBOARD_CONCURRENCY = int(os.getenv("DASHBOARD_CONCURRENCY", "10"))
+DASHBOARD_BUDGET = float(os.getenv("DASHBOARD_BUDGET", "2.5"))
+DASHBOARD_TOP = 5
+
+# Настройки кэшей
+# Общий индекс сокращённых ссылок: файл и число записей в памяти
+SHORT_INDEX_DB = os.getenv("SHORT_INDEX_DB", "shortlinks.db")
+SHORT_INDEX_SIZE = int(os.getenv("SHORT_INDEX_SIZE", "10000"))
+# Правила нормализации URL для индекса. Удаление меток отслеживания
+# выключено по умолчанию: короткая ссылка ведёт на URL первого сокращения,
+# и метки из более поздних ссылок были бы потеряны.
+URL_NORMALIZE_CASE = env_flag("URL_NORMALIZE_CASE", True)
+URL_NORMALIZE_TRAILING_SLASH = env_flag("URL_NORMALIZE_TRAILING_SLASH", True)
+URL_STRIP_TRACKING = env_flag("URL_STRIP_TRACKING", False)
+URL_TRACKING_PARAMS = {
+    p.strip().lower()
+    for p in os.getenv(
+        "URL_TRACKING_PARAMS",
+        "utm_source,utm_medium,utm_campaign,utm_term,utm_content,fbclid,gclid,yclid,_openstat"
+    ).split(",")
+    if p.strip()
+}
+# Статистика ссылок: время жизни записи (с) и максимальное число ключей
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "60"))
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "5000"))
+# История статистики: файл, глубина в днях (VK отдаёт не больше 30),
+# период фонового сборщика (с, 0 — выключен) и его параллельность
+STATS_HISTORY_FILE = os.getenv("STATS_HISTORY_FILE", "stats_history.json")
+STATS_HISTORY_DAYS = max(1, min(int(os.getenv("STATS_HISTORY_DAYS", "30")), 30))
+STATS_COLLECT_INTERVAL = float(os.getenv("STATS_COLLECT_INTERVAL", "900"))
+STATS_COLLECT_CONCURRENCY = int(os.getenv("STATS_COLLECT_CONCURRENCY", "4"))
+# Проверка доступности ссылок: таймаут, TTL успешных и неуспешных
+# результатов, одновременных запросов к одному хосту, пул соединений и кэш DNS
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "5"))
+PROBE_OK_TTL = float(os.getenv("PROBE_OK_TTL", "600"))
+PROBE_FAIL_TTL = float(os.getenv("PROBE_FAIL_TTL", "30"))
+PROBE_CACHE_SIZE = int(os.getenv("PROBE_CACHE_SIZE", "10000"))
+PROBE_PER_HOST = max(1, int(os.getenv("PROBE_PER_HOST", "4")))
+PROBE_MAX_CONNECTIONS = int(os.getenv("PROBE_MAX_CONNECTIONS", "100"))
+PROBE_DNS_TTL = int(os.getenv("PROBE_DNS_TTL", "300"))
+# Названия стран VK
+COUNTRIES_FILE = os.getenv("COUNTRIES_FILE", "countries.json")
+
 # Инициализация бота и диспетчера
-bot = Bot(BOT_TOKEN)
+bot = Bot(
+    BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
 dp = Dispatcher(storage=MemoryStorage())
 router = Router()
 
+# Метрики в текстовом формате Prometheus
+class Metrics:
+    """Минимальный потокобезопасный реестр счётчиков, gauge и гистограмм."""
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help)
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}  # (name, labels) -> [counts по бакетам, sum, count]
+        self._collectors = []
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def add_collector(self, collector):
+        """Функция, обновляющая gauge непосредственно перед выдачей метрик."""
+        self._collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def value(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Ошибка сбора метрик: {e}")
+        with self._lock:
+            series = {}
+            for (name, labels), value in list(self._counters.items()) + list(self._gauges.items()):
+                series.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), (counts, total, count) in self._histograms.items():
+                lines = series.setdefault(name, [])
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {count}')
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        output = []
+        for name in sorted(series):
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(series[name])
+        return "\n".join(output) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Время работы обработчиков апдейтов")
+metrics.describe("bot_handler_errors_total", "counter", "Ошибки обработчиков по типу исключения")
+metrics.describe("bot_handlers_in_flight", "gauge", "Обработчики, выполняющиеся сейчас")
+metrics.describe("bot_operation_seconds", "histogram", "Время работы проверок URL, вызовов VK и записи хранилища")
+metrics.describe("bot_operation_errors_total", "counter", "Исключения в операциях по типу")
+metrics.describe("bot_operations_in_flight", "gauge", "Операции, выполняющиеся сейчас")
+metrics.describe("bot_vk_request_seconds", "histogram", "Время HTTP-запросов к VK API по методу")
+metrics.describe("bot_vk_errors_total", "counter", "Ошибки VK API по методу и коду")
+metrics.describe("bot_vk_queue_wait_seconds", "histogram", "Ожидание токена в планировщике VK по приоритету")
+metrics.describe("bot_vk_queue_depth", "gauge", "Запросы в очереди планировщика VK по приоритету")
+metrics.describe("bot_storage_writes_total", "counter", "Записи файла хранилища")
+metrics.describe("bot_storage_write_bytes_total", "counter", "Байты, записанные в файл хранилища")
+metrics.describe("bot_storage_mutations_total", "counter", "Изменения данных хранилища")
+metrics.describe("bot_url_probe_total", "counter", "Проверки URL: из кэша, новые и присоединённые к идущей")
+metrics.describe("bot_flood_dropped_total", "counter", "Апдейты, отброшенные защитой от флуда, по обработчику и причине")
+metrics.describe("bot_outbound_wait_seconds", "histogram", "Ожидание отправки в очереди исходящих сообщений по приоритету")
+metrics.describe("bot_outbound_queue_depth", "gauge", "Исходящие запросы в очереди по приоритету")
+metrics.describe("bot_outbound_merged_total", "counter", "Правки сообщений, объединённые с ещё не отправленной правкой")
+metrics.describe("bot_outbound_retry_after_total", "counter", "Ответы Telegram RetryAfter на исходящие запросы")
+metrics.describe("bot_shard_updates_total", "counter", "Апдейты, переданные воркерам шардов")
+metrics.describe("bot_shard_errors_total", "counter", "Апдейты, которые не удалось передать воркеру шарда")
+metrics.describe("bot_shard_dropped_total", "counter", "Апдейты, отброшенные из-за переполнения очереди шарда")
+metrics.describe("bot_shard_queue_depth", "gauge", "Апдейты в очереди на передачу воркеру шарда")
+
+@contextmanager
+def measure_operation(operation):
+    """Время выполнения, исключения и число одновременных вызовов операции."""
+    metrics.add("bot_operations_in_flight", 1, operation=operation)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        metrics.inc("bot_operation_errors_total", operation=operation, kind=type(e).__name__)
+        raise
+    finally:
+        metrics.observe("bot_operation_seconds", time.perf_counter() - started, operation=operation)
+        metrics.add("bot_operations_in_flight", -1, operation=operation)
+
+def timed(operation):
+    """Декоратор: метрики операции (см. measure_operation) для каждого вызова функции."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with measure_operation(operation):
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with measure_operation(operation):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def handler_name(event, data):
+    """Имя обработчика для метрик: для кнопок — обработчик действия, а не общий маршрутизатор."""
+    if isinstance(event, types.CallbackQuery):
+        handler = callbacks.handler_for(event.data)
+        if handler is not None:
+            return handler.__name__
+    return getattr(getattr(data.get("handler"), "callback", None), "__name__", "unknown")
+
+# Middleware для замера обработчиков
+class MetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        name = handler_name(event, data)
+        metrics.add("bot_handlers_in_flight", 1, handler=name)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", handler=name, kind=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+            metrics.add("bot_handlers_in_flight", -1, handler=name)
+
+# Защита от флуда
+class FloodControl:
+    """Ограничивает частоту апдейтов пользователя и схлопывает повторные нажатия.
+
+    ``coalesce`` — outer-middleware апдейтов, регистрируется раньше
+    UserOrderingMiddleware: пока одинаковое нажатие пользователя ещё
+    обрабатывается (или ждёт в очереди), копии отбрасываются с коротким
+    ответом. ``limit`` — middleware обработчиков: корзина токенов на пару
+    (пользователь, обработчик) с лимитами из FLOOD_LIMITS; он же снимает
+    отметку о нажатии, когда обработчик завершился.
+    """
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, rate=FLOOD_RATE, burst=FLOOD_BURST, limits=FLOOD_LIMITS,
+                 inflight_ttl=FLOOD_INFLIGHT_TTL, enabled=FLOOD_CONTROL):
+        self.rate = rate
+        self.burst = burst
+        self.limits = limits
+        self.inflight_ttl = inflight_ttl
+        self.enabled = enabled
+        self._buckets = {}  # (user_id, обработчик) -> [токены, время пополнения, предупреждён]
+        self._inflight = {}  # (user_id, данные кнопки) -> время нажатия
+        self._pruned = time.monotonic()
+
+    def _prune(self, now):
+        self._pruned = now
+        self._inflight = {k: t for k, t in self._inflight.items() if now - t < self.inflight_ttl}
+        # Полная корзина ничем не отличается от отсутствующей
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if not self._is_full(key[1], bucket, now)}
+
+    def _limit(self, name):
+        return self.limits.get(name, (self.rate, self.burst))
+
+    def _is_full(self, name, bucket, now):
+        rate, burst = self._limit(name)
+        return bucket[0] + (now - bucket[1]) * rate >= burst
+
+    def _take(self, user_id, name, now):
+        """Берёт токен; возвращает 0 или сколько секунд ждать следующего."""
+        rate, burst = self._limit(name)
+        if rate <= 0:
+            return 0
+        bucket = self._buckets.get((user_id, name))
+        if bucket is None:
+            bucket = self._buckets[(user_id, name)] = [float(burst), now, False]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return 0
+        return (1 - bucket[0]) / rate
+
+    async def coalesce(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        cb = event.callback_query if isinstance(event, types.Update) else None
+        if not self.enabled or cb is None or cb.data is None:
+            return await handler(event, data)
+        now = time.monotonic()
+        if now - self._pruned > self.PRUNE_INTERVAL:
+            self._prune(now)
+        key = (cb.from_user.id, cb.data)
+        started = self._inflight.get(key)
+        if started is not None and now - started < self.inflight_ttl:
+            metrics.inc("bot_flood_dropped_total", handler=handler_name(cb, data), reason="duplicate")
+            await cb.answer("⏳ Уже выполняется, подождите...")
+            return None
+        self._inflight[key] = now
+        data["flood_key"] = key
+        try:
+            return await handler(event, data)
+        except Exception:
+            self._inflight.pop(key, None)
+            raise
+
+    async def limit(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        try:
+            user = data.get("event_from_user")
+            if not self.enabled or user is None:
+                return await handler(event, data)
+            name = handler_name(event, data)
+            wait = self._take(user.id, name, time.monotonic())
+            if not wait:
+                return await handler(event, data)
+            metrics.inc("bot_flood_dropped_total", handler=name, reason="rate")
+            logger.info(f"Флуд от пользователя {user.id} в {name}, повтор через {wait:.1f} с")
+            text = f"⏳ Слишком часто. Повторите через {max(1, round(wait))} с"
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(text)
+            elif isinstance(event, types.Message):
+                # В чат предупреждаем один раз, пока пользователь не уложится в лимит
+                bucket = self._buckets[(user.id, name)]
+                if not bucket[2]:
+                    bucket[2] = True
+                    await event.answer(text)
+            return None
+        finally:
+            key = data.get("flood_key")
+            if key is not None:
+                self._inflight.pop(key, None)
+
+flood_control = FloodControl()
+
+# Лимиты проверяются до замера: отброшенные апдейты не искажают время обработчиков
+router.message.middleware(flood_control.limit)
+router.callback_query.middleware(flood_control.limit)
+router.message.middleware(MetricsMiddleware())
+router.callback_query.middleware(MetricsMiddleware())
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# Очередь исходящих сообщений Telegram
+# Приоритет запросов текущей задачи; фоновые уведомления выставляют BACKGROUND
+outbound_priority = contextvars.ContextVar("outbound_priority", default=OUTBOUND_PRIORITY_INTERACTIVE)
+
+class OutboundRequest:
+    """Запрос в очереди исходящих: порядок — по приоритету, затем по времени постановки."""
+    __slots__ = ("priority", "seq", "chat_id", "method", "granted", "result", "newer")
+
+    def __init__(self, priority, seq, chat_id, method):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.granted = None
+        self.result = None  # общий результат для объединённых правок
+        self.newer = None  # следующая правка того же сообщения
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Middleware сессии бота: темп отправки сообщений в Telegram.
+
+    Запросы с chat_id (сообщения, правки, файлы) проходят через общую
+    корзину токенов и корзину своего чата. Ожидающие получают токены по
+    приоритету, внутри чата — в порядке постановки; чат, упёршийся в
+    лимит, не задерживает остальные. Ещё не отправленная правка сообщения
+    заменяется более новой правкой того же сообщения — уходит последнее
+    содержимое, результат получают все. На TelegramRetryAfter чат ставится
+    на паузу, запрос повторяется; правка, за которой уже пришла более
+    новая, не повторяется, а получает её результат. Остальные методы (ответы на нажатия,
+    удаление сообщений, служебные) идут без очереди.
+    """
+    PRUNE_INTERVAL = 60
+    # Не отправляют сообщений и под лимиты не попадают
+    UNPACED = (DeleteMessage, SendChatAction)
+
+    def __init__(self, rate=OUTBOUND_RATE, burst=OUTBOUND_BURST, chat_rate=OUTBOUND_CHAT_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST, max_retries=OUTBOUND_MAX_RETRIES):
+        self.rate = rate
+        self.burst = burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._chats = {}  # chat_id -> [токены, время пополнения, пауза до]
+        self._waiters = []  # OutboundRequest, отсортированы по приоритету
+        self._edits = {}  # (chat_id, message_id) -> правка, ещё ждущая отправки
+        self._latest = {}  # (chat_id, message_id) -> последняя незавершённая правка
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._pump_task = None
+        self._pruned = time.monotonic()
+
+    def _refill(self, chat_id, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = [float(self.chat_burst), now, 0.0]
+        chat[0] = min(self.chat_burst, chat[0] + (now - chat[1]) * self.chat_rate)
+        chat[1] = now
+        return chat
+
+    def _try_take(self, chat_id, now):
+        chat = self._refill(chat_id, now)
+        if chat[2] > now or self._tokens < 1 or chat[0] < 1:
+            return False
+        self._tokens -= 1
+        chat[0] -= 1
+        return True
+
+    def _delay(self, chat_id, now):
+        chat = self._chats[chat_id]
+        return max(
+            chat[2] - now,
+            (1 - chat[0]) / self.chat_rate,
+            (1 - self._tokens) / self.rate,
+            0.001,
+        )
+
+    def _prune(self, now):
+        self._pruned = now
+        busy = {request.chat_id for request in self._waiters}
+        self._chats = {
+            chat_id: chat for chat_id, chat in self._chats.items()
+            if chat_id in busy or chat[2] > now
+            or chat[0] + (now - chat[1]) * self.chat_rate < self.chat_burst
+        }
+
+    async def _pump(self):
+        while self._waiters:
+            self._wakeup.clear()
+            now = time.monotonic()
+            delay = None
+            for request in list(self._waiters):
+                if request.granted.done():  # ожидание отменено
+                    self._waiters.remove(request)
+                elif self._try_take(request.chat_id, now):
+                    self._waiters.remove(request)
+                    request.granted.set_result(None)
+                else:
+                    wait = self._delay(request.chat_id, now)
+                    delay = wait if delay is None else min(delay, wait)
+            if not self._waiters:
+                break
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, request):
+        started = time.monotonic()
+        if started - self._pruned > self.PRUNE_INTERVAL:
+            self._prune(started)
+        if self._waiters or not self._try_take(request.chat_id, started):
+            request.granted = asyncio.get_running_loop().create_future()
+            bisect.insort(self._waiters, request)
+            if self._pump_task is None or self._pump_task.done():
+                self._pump_task = asyncio.create_task(self._pump())
+            self._wakeup.set()
+            await request.granted
+        metrics.observe("bot_outbound_wait_seconds", time.monotonic() - started, priority=request.priority)
+
+    def _merge(self, key, method, priority):
+        """Подменяет содержимое ждущей правки; возвращает её общий результат или None."""
+        queued = self._edits.get(key)
+        if queued is None:
+            return None
+        queued.method = method
+        return self._share(queued, priority)
+
+    def _share(self, queued, priority):
+        # Интерактивная правка поднимает фоновую; получившая токен уже не в очереди
+        if priority < queued.priority and queued in self._waiters:
+            self._waiters.remove(queued)
+            queued.priority = priority
+            bisect.insort(self._waiters, queued)
+        metrics.inc("bot_outbound_merged_total")
+        return queued.result
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or isinstance(method, self.UNPACED):
+            return await make_request(bot, method)
+        priority = outbound_priority.get()
+        key = None
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            key = (chat_id, method.message_id)
+            shared = self._merge(key, method, priority)
+            if shared is not None:
+                return await asyncio.shield(shared)
+        request = OutboundRequest(priority, next(self._seq), chat_id, method)
+        if key is not None:
+            # Результат правки нужен и её устаревшим предшественницам на повторе
+            request.result = asyncio.get_running_loop().create_future()
+            request.result.add_done_callback(lambda f: f.cancelled() or f.exception())
+            previous = self._latest.get(key)
+            if previous is not None:
+                previous.newer = request
+            self._latest[key] = request
+        try:
+            for attempt in range(self.max_retries + 1):
+                if key is not None:
+                    # Не перехватываем ключ у более новой правки
+                    self._edits.setdefault(key, request)
+                await self._acquire(request)
+                if key is not None and self._edits.get(key) is request:
+                    # Отправляется — следующие правки встанут в очередь заново
+                    del self._edits[key]
+                try:
+                    result = await make_request(bot, request.method)
+                except TelegramRetryAfter as e:
+                    metrics.inc("bot_outbound_retry_after_total")
+                    if attempt == self.max_retries:
+                        raise
+                    logger.warning(f"Telegram ограничил отправку в чат {chat_id}, повтор через {e.retry_after} с")
+                    chat = self._refill(chat_id, time.monotonic())
+                    chat[0] = 0
+                    chat[2] = time.monotonic() + e.retry_after
+                    if request.newer is None:
+                        continue
+                    # Пока запрос был в работе, пришла более новая правка: устаревший
+                    # текст не повторяем, а ждём результата последней
+                    latest = request.newer
+                    while latest.newer is not None:
+                        latest = latest.newer
+                    result = await asyncio.shield(self._share(latest, priority))
+                if request.result is not None:
+                    request.result.set_result(result)
+                return result
+        except BaseException as e:
+            if request.result is not None and not request.result.done():
+                if isinstance(e, asyncio.CancelledError):
+                    request.result.cancel()
+                else:
+                    request.result.set_exception(e)
+            raise
+        finally:
+            if key is not None and self._edits.get(key) is request:
+                del self._edits[key]
+            if key is not None and self._latest.get(key) is request:
+                del self._latest[key]
+            if request.granted is not None and not request.granted.done():
+                request.granted.cancel()
+
+    def queue_depth(self):
+        depth = {p: 0 for p in OUTBOUND_PRIORITIES}
+        for request in self._waiters:
+            if not request.granted.done():
+                depth[request.priority] += 1
+        return depth
+
+outbound_scheduler = OutboundScheduler()
+bot.session.middleware(outbound_scheduler)
+
+def collect_outbound_queue_metrics():
+    for priority, depth in outbound_scheduler.queue_depth().items():
+        metrics.set("bot_outbound_queue_depth", depth, priority=priority)
+
+metrics.add_collector(collect_outbound_queue_metrics)
+
+async def send_background(chat_id, text):
+    """Уведомление вне ответа на апдейт: в очереди исходящих уступает интерактивным."""
+    outbound_priority.set(OUTBOUND_PRIORITY_BACKGROUND)
+    try:
+        await bot.send_message(chat_id, text)
+    except Exception as e:
+        logger.error(f"Ошибка отправки уведомления {chat_id}: {str(type(e).__name__)} - {str(e)[:100]}")
+
 # Middleware для передачи vk_session
 class VKSessionMiddleware(BaseMiddleware):
     def __init__(self, vk_session: aiohttp.ClientSession):
@@ -54,19 +777,98 @@ class VKSessionMiddleware(BaseMiddleware):
         data["vk_session"] = self.vk_session
         return await handler(event, data)
 
+# Middleware параллельной обработки апдейтов
+class UserOrderingMiddleware(BaseMiddleware):
+    """Обрабатывает апдейты параллельно, сохраняя порядок для каждого пользователя.
+
+    Регистрируется как outer-middleware апдейтов: запускает обработку в
+    отдельной задаче и сразу возвращает управление поллингу. Апдейты одного
+    пользователя выполняются строго друг за другом (переходы FSM остаются
+    корректными), одновременно в работе не больше ``limit`` апдейтов; когда
+    пул заполнен, приём новых апдейтов ждёт освобождения места.
+    """
+    def __init__(self, limit=UPDATE_CONCURRENCY):
+        super().__init__()
+        self.limit = limit
+        self._slots = asyncio.Semaphore(limit)
+        self._tails = {}  # user_id -> последняя задача пользователя
+        self._tasks = set()
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if self._slots.locked():
+            logger.debug(f"Пул обработчиков заполнен ({self.limit}), ожидаем свободного места")
+        await self._slots.acquire()
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        key = user.id if user else (chat.id if chat else None)
+        previous = self._tails.get(key) if key is not None else None
+        task = asyncio.create_task(self._run(handler, event, data, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if key is not None:
+            self._tails[key] = task
+            task.add_done_callback(lambda t: self._tails.get(key) is t and self._tails.pop(key))
+
+    async def _run(self, handler, event, data, previous):
+        try:
+            if previous is not None:
+                # Ждём предыдущий апдейт пользователя, не пробрасывая его ошибки
+                await asyncio.wait([previous])
+            # FSMContextMiddleware прочитал состояние при получении апдейта — пока
+            # ждали место в пуле или предыдущий апдейт, оно могло измениться
+            if "state" in data:
+                data["raw_state"] = await data["state"].get_state()
+            return await handler(event, data)
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта: {str(type(e).__name__)} - {str(e)[:100]}")
+        finally:
+            self._slots.release()
+
+    async def drain(self):
+        """Дожидается завершения всех начатых апдейтов."""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
 # Класс состояний
 class LinkForm(StatesGroup):
     waiting_for_link = State()
     waiting_for_title = State()
     waiting_for_link_action = State()
     waiting_for_rename = State()
+    waiting_for_bulk = State()
+
+# Уведомление пользователя об удалении старых ссылок из-за лимита
+def notify_links_evicted(user_id, titles):
+    if not titles:
+        return
+    if len(titles) == 1:
+        text = f"ℹ️ Старая ссылка '{titles[0]}' удалена из-за лимита в {MAX_LINKS_PER_USER} ссылок."
+    else:
+        text = f"ℹ️ Из-за лимита в {MAX_LINKS_PER_USER} ссылок удалено старых ссылок: {len(titles)}."
+    asyncio.create_task(send_background(user_id, text))
 
 # Класс для работы с JSON
 class JsonStorage:
-    """Хранилище ссылок в JSON-файле с потокобезопасной записью."""
-    def __init__(self, file_name="links.json"):
+    """Хранилище ссылок в JSON-файле.
+
+    Изменения только помечают хранилище «грязным», а фоновая задача раз в
+    ``flush_interval`` секунд снимает снимок данных и атомарно записывает его
+    вне event loop. При ``flush_interval <= 0`` запись выполняется сразу после
+    каждого изменения (прежнее поведение).
+    """
+    def __init__(self, file_name="links.json", flush_interval=STORAGE_FLUSH_INTERVAL):
         self.file_name = file_name
+        self.flush_interval = flush_interval
         self.data = self._load_data()
+        self._dirty = False
+        self._write_lock = threading.Lock()
+        self._flush_task = None
+        self._stopping = None
 
     def _load_data(self):
         try:
@@ -76,19 +878,78 @@ class JsonStorage:
             logger.error(f"Ошибка загрузки JSON: {e}")
             return {}
 
-    def _save_data(self):
+    def _snapshot(self):
+        # Копируем только структуру списков и словарей — это на порядки дешевле
+        # сериализации, поэтому json_lock держится минимальное время.
         with json_lock:
+            return {uid: [dict(link) for link in links] for uid, links in self.data.items()}
+
+    @timed("storage_save")
+    def _save_data(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self._snapshot()
+        tmp_name = f"{self.file_name}.tmp"
+        with self._write_lock:
             try:
-                with open(self.file_name, 'w', encoding='utf-8') as f:
-                    json.dump(self.data, f, ensure_ascii=False, indent=2)
+                with open(tmp_name, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    written = f.tell()
+                os.replace(tmp_name, self.file_name)
+                metrics.inc("bot_storage_writes_total")
+                metrics.inc("bot_storage_write_bytes_total", written)
             except Exception as e:
                 logger.error(f"Ошибка записи JSON: {e}")
                 raise
 
-    def get_user_links(self, user_id):
+    def _mark_dirty(self):
+        metrics.inc("bot_storage_mutations_total")
+        if self.flush_interval > 0:
+            self._dirty = True
+        else:
+            self._save_data()
+
+    async def flush(self):
+        """Записывает накопленные изменения одним снимком вне event loop."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        snapshot = self._snapshot()
+        try:
+            await asyncio.to_thread(self._save_data, snapshot)
+        except Exception:
+            # Повторим попытку на следующем тике
+            self._dirty = True
+
+    async def _flush_loop(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    def start(self):
+        if self.flush_interval > 0 and self._flush_task is None:
+            self._stopping = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+            logger.info(f"Отложенная запись JSON включена (интервал {self.flush_interval} с)")
+
+    async def close(self):
+        if self._flush_task is not None:
+            # Не отменяем задачу: отмена посреди записи потеряла бы флаг _dirty,
+            # и итоговая запись ниже ничего бы не сохранила
+            self._stopping.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        if self._dirty:
+            logger.error(f"Не удалось сохранить изменения в {self.file_name} при остановке")
+
+    async def get_user_links(self, user_id):
         return self.data.get(str(user_id), [])
 
-    def add_link(self, user_id, link_data):
+    async def add_link(self, user_id, link_data):
         uid = str(user_id)
         with json_lock:
             self.data.setdefault(uid, [])
@@ -96,41 +957,252 @@ class JsonStorage:
             if any(link['original'] == link_data['original'] for link in self.data[uid]):
                 logger.info(f"Попытка добавить дублирующую ссылку для {uid}: {link_data['original']}")
                 return False
-            if len(self.data[uid]) >= 50:
+            if len(self.data[uid]) >= MAX_LINKS_PER_USER:
                 removed_link = self.data[uid].pop(0)
                 logger.info(f"Удалена старая ссылка для {uid}: {removed_link['title']}")
-                # Уведомление пользователя
-                asyncio.create_task(
-                    bot.send_message(user_id, f"ℹ️ Старая ссылка '{removed_link['title']}' удалена из-за лимита в 50 ссылок.")
-                )
+                notify_links_evicted(user_id, [removed_link['title']])
             self.data[uid].append(link_data)
-            self._save_data()
-            logger.info(f"Добавлена ссылка для {uid}: {link_data['title']} ({link_data['original']})")
-            return True
+        self._mark_dirty()
+        logger.info(f"Добавлена ссылка для {uid}: {link_data['title']} ({link_data['original']})")
+        return True
 
-    def delete_link(self, user_id, link_index):
+    async def all_link_keys(self):
+        with json_lock:
+            return {link['key'] for links in self.data.values() for link in links if link.get('key')}
+
+    async def add_links(self, user_id, links):
+        """Добавляет пачку ссылок одним изменением; возвращает (добавленные, дубликаты)."""
         uid = str(user_id)
+        added, duplicates = [], []
         with json_lock:
-            if uid in self.data and 0 <= link_index < len(self.data[uid]):
-                self.data[uid].pop(link_index)
-                self._save_data()
-                return True
-        return False
+            user_links = self.data.setdefault(uid, [])
+            known = {link['original'] for link in user_links}
+            for link_data in links:
+                if link_data['original'] in known:
+                    duplicates.append(link_data)
+                    continue
+                known.add(link_data['original'])
+                user_links.append(link_data)
+                added.append(link_data)
+            overflow = max(0, len(user_links) - MAX_LINKS_PER_USER)
+            removed = user_links[:overflow]
+            del user_links[:overflow]
+        if added:
+            self._mark_dirty()
+        if removed:
+            logger.info(f"Удалено старых ссылок для {uid}: {len(removed)}")
+        notify_links_evicted(user_id, [link['title'] for link in removed])
+        logger.info(f"Пакетно добавлено ссылок для {uid}: {len(added)}, дубликатов: {len(duplicates)}")
+        return added, duplicates
 
-    def rename_link(self, user_id, link_index, new_title):
+    async def delete_link(self, user_id, link_index):
         uid = str(user_id)
         with json_lock:
-            if uid in self.data and 0 <= link_index < len(self.data[uid]):
-                self.data[uid][link_index]["title"] = new_title[:100]
-                self._save_data()
-                return True
-        return False
+            if not (uid in self.data and 0 <= link_index < len(self.data[uid])):
+                return False
+            self.data[uid].pop(link_index)
+        self._mark_dirty()
+        return True
+
+    async def rename_link(self, user_id, link_index, new_title):
+        uid = str(user_id)
+        with json_lock:
+            if not (uid in self.data and 0 <= link_index < len(self.data[uid])):
+                return False
+            self.data[uid][link_index]["title"] = new_title[:100]
+        self._mark_dirty()
+        return True
+
+# Класс для работы с SQLite
+class SqliteStorage:
+    """Хранилище ссылок в SQLite с тем же интерфейсом, что и JsonStorage.
+
+    Запросы выполняются в пуле потоков (у каждого потока своё соединение),
+    поэтому event loop не блокируется.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS links (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            short TEXT NOT NULL,
+            original TEXT NOT NULL,
+            key TEXT,
+            created TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_links_user_created ON links(user_id, created);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_links_user_original ON links(user_id, original);
+    """
+    # Ссылки пользователя в порядке добавления — так же, как список в JSON
+    ORDER = "ORDER BY created, id"
+    # Лимит ссылок на пользователя — одним запросом
+    TRIM_SQL = (
+        "DELETE FROM links WHERE id IN ("
+        "SELECT id FROM links WHERE user_id = ? ORDER BY created DESC, id DESC LIMIT -1 OFFSET ?"
+        ") RETURNING title"
+    )
+
+    def __init__(self, file_name="links.db", max_workers=4):
+        self.file_name = file_name
+        self._local = threading.local()
+        self._connections = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sqlite")
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.file_name, timeout=10, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._connections.append(conn)
+        return conn
+
+    async def _run(self, func, *args):
+        with measure_operation(f"sqlite{func.__name__}"):
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def start(self):
+        pass
+
+    async def close(self):
+        self._executor.shutdown(wait=True)
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
+
+    def _get_user_links(self, uid):
+        rows = self._conn().execute(
+            f"SELECT title, short, original, key, created FROM links WHERE user_id = ? {self.ORDER}",
+            (uid,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _all_link_keys(self):
+        rows = self._conn().execute("SELECT DISTINCT key FROM links WHERE key IS NOT NULL").fetchall()
+        return {row['key'] for row in rows}
+
+    def _add_link(self, uid, link_data):
+        conn = self._conn()
+        with conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO links (user_id, title, short, original, key, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (uid, link_data['title'], link_data['short'], link_data['original'], link_data.get('key'), link_data['created'])
+            )
+            if cur.rowcount == 0:
+                return False, []
+            removed = conn.execute(self.TRIM_SQL, (uid, MAX_LINKS_PER_USER)).fetchall()
+        return True, [row['title'] for row in removed]
 
-storage = JsonStorage()
+    def _add_links(self, uid, links):
+        conn = self._conn()
+        added, duplicates = [], []
+        with conn:
+            for link_data in links:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO links (user_id, title, short, original, key, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (uid, link_data['title'], link_data['short'], link_data['original'], link_data.get('key'), link_data['created'])
+                )
+                (added if cur.rowcount else duplicates).append(link_data)
+            removed = conn.execute(self.TRIM_SQL, (uid, MAX_LINKS_PER_USER)).fetchall()
+        return added, duplicates, [row['title'] for row in removed]
+
+    def _delete_link(self, uid, link_index):
+        conn = self._conn()
+        with conn:
+            cur = conn.execute(
+                f"DELETE FROM links WHERE id = (SELECT id FROM links WHERE user_id = ? {self.ORDER} LIMIT 1 OFFSET ?)",
+                (uid, link_index)
+            )
+        return cur.rowcount > 0
+
+    def _rename_link(self, uid, link_index, new_title):
+        conn = self._conn()
+        with conn:
+            cur = conn.execute(
+                f"UPDATE links SET title = ? WHERE id = (SELECT id FROM links WHERE user_id = ? {self.ORDER} LIMIT 1 OFFSET ?)",
+                (new_title, uid, link_index)
+            )
+        return cur.rowcount > 0
+
+    async def get_user_links(self, user_id):
+        return await self._run(self._get_user_links, str(user_id))
+
+    async def all_link_keys(self):
+        return await self._run(self._all_link_keys)
+
+    async def add_link(self, user_id, link_data):
+        uid = str(user_id)
+        added, removed_titles = await self._run(self._add_link, uid, link_data)
+        if not added:
+            logger.info(f"Попытка добавить дублирующую ссылку для {uid}: {link_data['original']}")
+            return False
+        for title in removed_titles:
+            logger.info(f"Удалена старая ссылка для {uid}: {title}")
+        notify_links_evicted(user_id, removed_titles)
+        logger.info(f"Добавлена ссылка для {uid}: {link_data['title']} ({link_data['original']})")
+        return True
+
+    async def add_links(self, user_id, links):
+        uid = str(user_id)
+        added, duplicates, removed_titles = await self._run(self._add_links, uid, links)
+        if removed_titles:
+            logger.info(f"Удалено старых ссылок для {uid}: {len(removed_titles)}")
+        notify_links_evicted(user_id, removed_titles)
+        logger.info(f"Пакетно добавлено ссылок для {uid}: {len(added)}, дубликатов: {len(duplicates)}")
+        return added, duplicates
+
+    async def delete_link(self, user_id, link_index):
+        if link_index < 0:
+            return False
+        return await self._run(self._delete_link, str(user_id), link_index)
+
+    async def rename_link(self, user_id, link_index, new_title):
+        if link_index < 0:
+            return False
+        return await self._run(self._rename_link, str(user_id), link_index, new_title[:100])
+
+# Однократный перенос ссылок из links.json в SQLite
+def migrate_json_to_sqlite(json_file=LINKS_FILE, db_file=LINKS_DB):
+    with open(json_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    target = SqliteStorage(db_file, max_workers=1)
+    conn = target._conn()
+    rows = [
+        (str(uid), link.get('title', '')[:100], link.get('short', ''), link['original'], link.get('key'), link.get('created', ''))
+        for uid, links in data.items()
+        for link in links
+        if isinstance(link, dict) and link.get('original')
+    ]
+    with conn:
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO links (user_id, title, short, original, key, created) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        migrated = conn.total_changes - before
+    conn.close()
+    target._executor.shutdown()
+    logger.info(f"Перенесено {migrated} из {len(rows)} ссылок из {json_file} в {db_file}")
+    return migrated
+
+def create_storage():
+    if STORAGE_BACKEND == "sqlite":
+        logger.info(f"Хранилище: SQLite ({LINKS_DB})")
+        return SqliteStorage(LINKS_DB)
+    logger.info(f"Хранилище: JSON ({LINKS_FILE})")
+    return JsonStorage(LINKS_FILE)
+
+storage = create_storage()
 
 # Очистка URL для безопасного логирования
 def sanitize_url(url):
-    parsed = urlparse(url)
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return "[некорректный URL]"
     query_params = parse_qs(parsed.query)
     sensitive_params = ['token', 'password', 'key']
     for param in sensitive_params:
@@ -139,98 +1211,890 @@ def sanitize_url(url):
     query = "&".join(f"{k}={v[0]}" for k, v in query_params.items()) if query_params else ""
     return parsed._replace(query=query).geturl()
 
+# Нормализация URL для общего индекса сокращённых ссылок
+def normalize_url(url):
+    try:
+        parsed = urlparse(url.strip())
+        port = parsed.port
+    except ValueError:
+        # Некорректный порт или IPv6-адрес: такой URL отсеет проверка, ключом служит как есть
+        return url.strip()
+    if URL_NORMALIZE_CASE:
+        host = (parsed.hostname or "").lower()
+        netloc = host if port is None else f"{host}:{port}"
+        if parsed.username is not None:
+            userinfo = parsed.username if parsed.password is None else f"{parsed.username}:{parsed.password}"
+            netloc = f"{userinfo}@{netloc}"
+        parsed = parsed._replace(scheme=parsed.scheme.lower(), netloc=netloc)
+    if URL_NORMALIZE_TRAILING_SLASH and parsed.path.endswith("/"):
+        parsed = parsed._replace(path=parsed.path.rstrip("/"))
+    if URL_STRIP_TRACKING and parsed.query:
+        query = [
+            (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+            if k.lower() not in URL_TRACKING_PARAMS
+        ]
+        parsed = parsed._replace(query=urlencode(query))
+    return parsed.geturl()
+
+class ShortLinkIndex:
+    """Общий для всех пользователей индекс «нормализованный URL → (short, key)».
+
+    Позволяет не проверять и не сокращать повторно уже известные ссылки.
+    В памяти хранится не больше ``max_size`` записей (LRU), полный индекс —
+    в SQLite-файле.
+    """
+    def __init__(self, file_name=SHORT_INDEX_DB, max_size=SHORT_INDEX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(file_name, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS short_links (url TEXT PRIMARY KEY, short TEXT NOT NULL, key TEXT NOT NULL)"
+        )
+
+    def _remember(self, norm_url, value):
+        self._entries[norm_url] = value
+        self._entries.move_to_end(norm_url)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _db_get(self, norm_url):
+        with self._db_lock:
+            row = self._db.execute("SELECT short, key FROM short_links WHERE url = ?", (norm_url,)).fetchone()
+        return tuple(row) if row else None
+
+    def _db_put(self, norm_url, short_url, key):
+        with self._db_lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO short_links (url, short, key) VALUES (?, ?, ?)",
+                (norm_url, short_url, key)
+            )
+
+    async def get(self, url):
+        norm_url = normalize_url(url)
+        value = self._entries.get(norm_url)
+        if value is None:
+            value = await asyncio.to_thread(self._db_get, norm_url)
+            if value is None:
+                return None
+        self._remember(norm_url, value)
+        return value
+
+    async def put(self, url, short_url, key):
+        norm_url = normalize_url(url)
+        self._remember(norm_url, (short_url, key))
+        try:
+            await asyncio.to_thread(self._db_put, norm_url, short_url, key)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи индекса ссылок: {e}")
+
+    def close(self):
+        self._db.close()
+
+short_index = ShortLinkIndex()
+
+# Проверка доступности ссылок
+class UrlProber:
+    """Проверяет, что сайт по ссылке отвечает, перед её сокращением.
+
+    Результаты кэшируются (успешные — на ``ok_ttl``, неуспешные — на более
+    короткий ``fail_ttl``), одновременные проверки одного URL делят один
+    запрос, к одному хосту одновременно идёт не больше ``per_host``
+    запросов. Если сайт не поддерживает HEAD, проверка повторяется GET-ом
+    первого байта. У проверок свой пул соединений с кэшем DNS, отдельный
+    от сессии VK.
+    """
+    # Ответы на HEAD, после которых пробуем GET
+    HEAD_UNSUPPORTED = (403, 405, 501)
+
+    def __init__(self, timeout=PROBE_TIMEOUT, ok_ttl=PROBE_OK_TTL, fail_ttl=PROBE_FAIL_TTL,
+                 per_host=PROBE_PER_HOST, max_size=PROBE_CACHE_SIZE):
+        self.timeout = timeout
+        self.ok_ttl = ok_ttl
+        self.fail_ttl = fail_ttl
+        self.per_host = per_host
+        self.max_size = max_size
+        self._entries = OrderedDict()  # нормализованный URL -> (результат, истекает)
+        self._inflight = {}
+        self._hosts = {}  # хост -> [Semaphore, число ожидающих и выполняющихся проверок]
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            # Лимит на хост держим своим семафором: очередь пула aiohttp
+            # засчитывается в таймаут запроса, и ожидающие проверки падали бы по нему
+            connector = aiohttp.TCPConnector(
+                limit=PROBE_MAX_CONNECTIONS, limit_per_host=0,
+                use_dns_cache=True, ttl_dns_cache=PROBE_DNS_TTL
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": "Mozilla/5.0 (compatible; LinkCheckBot/1.0)"}
+            )
+        return self._session
+
+    def _store(self, norm_url, ok):
+        self._entries[norm_url] = (ok, time.monotonic() + (self.ok_ttl if ok else self.fail_ttl))
+        self._entries.move_to_end(norm_url)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _request(self, url):
+        sanitized_url = sanitize_url(url)
+        session = self._get_session()
+        try:
+            async with session.head(url, allow_redirects=False) as r:
+                status = r.status
+            if status in self.HEAD_UNSUPPORTED:
+                async with session.get(url, headers={"Range": "bytes=0-0"}, allow_redirects=False) as r:
+                    status = r.status
+        except aiohttp.ClientError as e:
+            logger.error(f"Ошибка проверки URL {sanitized_url}: {e}")
+            return False
+        except asyncio.TimeoutError:
+            logger.error(f"Таймаут при проверке URL {sanitized_url}")
+            return False
+        if status == 429:
+            logger.warning(f"Слишком много запросов для {sanitized_url}")
+        return 200 <= status < 400
+
+    async def _probe(self, url, norm_url):
+        host = urlparse(url).hostname or ""
+        slot = self._hosts.setdefault(host, [asyncio.Semaphore(self.per_host), 0])
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                ok = await self._request(url)
+            self._store(norm_url, ok)
+            return ok
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                self._hosts.pop(host, None)
+            self._inflight.pop(norm_url, None)
+
+    async def check(self, url):
+        try:
+            urlparse(url).port
+        except ValueError as e:
+            logger.error(f"Недействительный URL {sanitize_url(url)}: {e}")
+            return False
+        norm_url = normalize_url(url)
+        entry = self._entries.get(norm_url)
+        if entry is not None and entry[1] > time.monotonic():
+            metrics.inc("bot_url_probe_total", result="cached")
+            return entry[0]
+        task = self._inflight.get(norm_url)
+        if task is None:
+            metrics.inc("bot_url_probe_total", result="probed")
+            task = self._inflight[norm_url] = asyncio.create_task(self._probe(url, norm_url))
+        else:
+            metrics.inc("bot_url_probe_total", result="joined")
+        # shield: отмена одного ожидающего не должна отменять общую проверку
+        return await asyncio.shield(task)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+url_prober = UrlProber()
+
 # Проверка валидности URL
-async def is_valid_url(url, session):
-    sanitized_url = sanitize_url(url)
+@timed("is_valid_url")
+async def is_valid_url(url, session=None):
+    """Синтаксис и доступность URL; ``session`` не используется — у проверок свой пул."""
     if not re.match(r'^https?://[^\s]+$', url):
-        logger.error(f"Недействительный URL: {sanitized_url}")
+        logger.error(f"Недействительный URL: {sanitize_url(url)}")
         return False
+    return await url_prober.check(url)
+
+# Вызовы VK API
+class VKError(Exception):
+    """Ошибка VK API: код ошибки VK или HTTP-статус ответа."""
+    def __init__(self, code, message, http_status=None):
+        super().__init__(f"[{code}] {message}")
+        self.code = code
+        self.message = message
+        self.http_status = http_status
+
+async def vk_request(method, params, session):
+    """Один HTTP-запрос к VK API. Возвращает разобранный JSON ответа."""
+    payload = {**params, "access_token": VK_TOKEN, "v": VK_API_VERSION}
+    started = time.perf_counter()
     try:
-        async with session.head(url, timeout=5) as r:
-            if r.status in (200, 301, 302):
-                return True
-            elif r.status == 429:
-                logger.warning(f"Слишком много запросов для {sanitized_url}")
-                return False
-            return False
-    except aiohttp.ClientError as e:
-        logger.error(f"Ошибка проверки URL {sanitized_url}: {e}")
-        return False
-    except asyncio.TimeoutError:
-        logger.error(f"Таймаут при проверке URL {sanitized_url}")
-        return False
+        async with session.post(f"{VK_API_URL}/{method}", data=payload, timeout=5) as resp:
+            if resp.status != 200:
+                raise VKError(None, f"VK API вернул статус {resp.status}", http_status=resp.status)
+            data = await resp.json(content_type=None)
+        if not isinstance(data, dict):
+            raise VKError(None, "Некорректный формат ответа VK API")
+        if 'error' in data:
+            error = data['error']
+            raise VKError(error.get('error_code'), error.get('error_msg', 'Неизвестная ошибка'))
+        for error in data.get('execute_errors', []):
+            metrics.inc("bot_vk_errors_total", method=error.get('method', method), code=error.get('error_code'))
+        return data
+    except VKError as e:
+        metrics.inc("bot_vk_errors_total", method=method, code=e.code if e.code is not None else f"http_{e.http_status}")
+        raise
+    except Exception as e:
+        metrics.inc("bot_vk_errors_total", method=method, code=type(e).__name__)
+        raise
+    finally:
+        metrics.observe("bot_vk_request_seconds", time.perf_counter() - started, method=method)
+
+def is_rate_limit_error(error):
+    return error.code == VK_TOO_MANY_REQUESTS or error.http_status == 429
+
+class VKScheduler:
+    """Единая очередь запросов к VK API.
+
+    Токен-бакет ограничивает частоту запросов квотой токена, ожидающие
+    запросы получают токены в порядке приоритета (меньше — важнее), а ошибки
+    6/429 повторяются с экспоненциальной задержкой со случайным разбросом.
+    """
+    def __init__(self, rate=VK_RPS, burst=VK_BURST, max_retries=VK_MAX_RETRIES, backoff=VK_BACKOFF_BASE):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._waiters = []  # куча (priority, seq, future)
+        self._seq = itertools.count()
+        self._pump_task = None
+        # Статистика для оценки ёмкости
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.wait_count = {p: 0 for p in VK_PRIORITIES}
+        self.wait_total = {p: 0.0 for p in VK_PRIORITIES}
+        self.wait_max = {p: 0.0 for p in VK_PRIORITIES}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def _pump(self):
+        while self._waiters:
+            self._refill()
+            if self._tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():
+                    continue
+                self._tokens -= 1
+                future.set_result(None)
+            else:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _acquire(self, priority):
+        started = time.monotonic()
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._seq), future))
+            if self._pump_task is None or self._pump_task.done():
+                self._pump_task = asyncio.create_task(self._pump())
+            await future
+        waited = time.monotonic() - started
+        metrics.observe("bot_vk_queue_wait_seconds", waited, priority=priority)
+        self.wait_count[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+        return waited
+
+    async def request(self, method, params, session, priority=VK_PRIORITY_INTERACTIVE):
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority)
+            self.requests += 1
+            try:
+                return await vk_request(method, params, session)
+            except VKError as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                self.rate_limited += 1
+                self.retries += 1
+                # Квота исчерпана — остальные запросы тоже должны подождать
+                self._tokens = 0
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                logger.warning(f"VK ограничил частоту запросов ({method}), повтор через {delay:.2f} с")
+                await asyncio.sleep(delay)
+
+    def queue_depth(self):
+        depth = {p: 0 for p in VK_PRIORITIES}
+        for priority, _, future in self._waiters:
+            if not future.done():
+                depth[priority] += 1
+        return depth
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "wait_avg": {p: self.wait_total[p] / self.wait_count[p] if self.wait_count[p] else 0.0 for p in VK_PRIORITIES},
+            "wait_max": dict(self.wait_max),
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+        }
+
+    async def report_loop(self, interval=VK_STATS_LOG_INTERVAL):
+        last_requests = 0
+        while True:
+            await asyncio.sleep(interval)
+            if self.requests != last_requests:
+                last_requests = self.requests
+                logger.info(f"Очередь VK API: {self.stats()}")
+
+vk_scheduler = VKScheduler()
+
+def collect_vk_queue_metrics():
+    for priority, depth in vk_scheduler.queue_depth().items():
+        metrics.set("bot_vk_queue_depth", depth, priority=priority)
+
+metrics.add_collector(collect_vk_queue_metrics)
+
+class VKBatcher:
+    """Объединяет вызовы методов VK в пакеты через метод execute.
+
+    Вызовы одного приоритета копятся ``window`` секунд (или до ``max_size``
+    штук) и уходят одним запросом через планировщик; результаты и ошибки
+    возвращаются вызывающим корутинам по порядку. Одиночный вызов
+    отправляется напрямую.
+    """
+    def __init__(self, window=VK_BATCH_WINDOW, max_size=VK_BATCH_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}  # priority -> [(method, params, future)]
+        self._timers = {}
+        self._session = None
+
+    async def call(self, method, params, session, priority=VK_PRIORITY_INTERACTIVE):
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.setdefault(priority, [])
+        pending.append((method, params, future))
+        self._session = session
+        if len(pending) >= self.max_size:
+            self._flush(priority)
+        elif priority not in self._timers:
+            self._timers[priority] = asyncio.get_running_loop().call_later(self.window, self._flush, priority)
+        return await future
+
+    def _flush(self, priority):
+        timer = self._timers.pop(priority, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._pending.pop(priority, [])
+        for i in range(0, len(pending), self.max_size):
+            asyncio.create_task(self._send(pending[i:i + self.max_size], self._session, priority))
+
+    @staticmethod
+    def _execute_code(batch):
+        calls = ",".join(
+            f"API.{method}({json.dumps(params, ensure_ascii=False)})" for method, params, _ in batch
+        )
+        return f"return [{calls}];"
+
+    async def _send(self, batch, session, priority):
+        batch = [item for item in batch if not item[2].done()]
+        if not batch:
+            return
+        try:
+            if len(batch) == 1:
+                method, params, future = batch[0]
+                data = await vk_scheduler.request(method, params, session, priority)
+                if not future.done():
+                    future.set_result(data.get('response'))
+                return
+            data = await vk_scheduler.request("execute", {"code": self._execute_code(batch)}, session, priority)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        results = data.get('response')
+        if not isinstance(results, list) or len(results) != len(batch):
+            results = [False] * len(batch)
+        # execute_errors перечислены в порядке неудавшихся вызовов
+        errors = iter(data.get('execute_errors', []))
+        for (method, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if result is False:
+                error = next(errors, {})
+                future.set_exception(VKError(error.get('error_code'), error.get('error_msg', f'Ошибка вызова {method}')))
+            else:
+                future.set_result(result)
+
+vk_batcher = VKBatcher()
+
+async def vk_call(method, params, session, priority=VK_PRIORITY_INTERACTIVE):
+    """Вызов метода VK API через общий пакетировщик и планировщик."""
+    return await vk_batcher.call(method, params, session, priority)
 
 # Функция сокращения ссылки через VK API
-async def shorten_link_vk(url, session):
+@timed("shorten_link_vk")
+async def shorten_link_vk(url, session, priority=VK_PRIORITY_INTERACTIVE):
     sanitized_url = sanitize_url(url)
     if len(url) > 2048:
         logger.error(f"URL слишком длинный: {sanitized_url}")
         return None, None, "URL превышает допустимую длину (2048 символов)"
     if not await is_valid_url(url, session):
         return None, None, "Недействительный или недоступный URL"
-    encoded_url = quote(url, safe='')
     try:
-        async with session.get(
-            f"https://api.vk.com/method/utils.getShortLink?url={encoded_url}&v=5.199&access_token={VK_TOKEN}",
-            timeout=5
-        ) as resp:
-            if resp.status != 200:
-                logger.error(f"VK API вернул статус {resp.status} для {sanitized_url}")
-                return None, None, "Ошибка сервера VK"
-            data = await resp.json()
-            if not isinstance(data, dict):
-                logger.error(f"Некорректный формат ответа VK API для {sanitized_url}")
-                return None, None, "Некорректный ответ VK API"
-            if 'response' in data and 'short_url' in data['response']:
-                return data['response']['short_url'], data['response']['key'], ""
-            logger.error(f"Ошибка VK API для {sanitized_url}: {data.get('error', 'Неизвестная ошибка')}")
-            return None, None, "Ошибка VK API"
+        response = await vk_call("utils.getShortLink", {"url": url}, session, priority)
+    except VKError as e:
+        logger.error(f"Ошибка VK API для {sanitized_url}: {e}")
+        if is_rate_limit_error(e):
+            return None, None, "VK временно ограничил запросы, попробуйте через минуту"
+        if e.http_status is not None:
+            return None, None, "Ошибка сервера VK"
+        return None, None, "Ошибка VK API"
     except Exception as e:
         logger.error(f"Ошибка при сокращении ссылки {sanitized_url}: {e}")
         return None, None, "Не удалось сократить ссылку"
+    if not isinstance(response, dict) or 'short_url' not in response:
+        logger.error(f"Некорректный формат ответа VK API для {sanitized_url}")
+        return None, None, "Некорректный ответ VK API"
+    return response['short_url'], response['key'], ""
 
 # Функция получения статистики по ссылке
+def empty_stats():
+    return {"views": 0, "countries": {}}
+
+@timed("get_link_stats")
+async def fetch_link_stats(key, session, priority=VK_PRIORITY_STATS):
+    """Запрашивает статистику у VK за STATS_HISTORY_DAYS дней; при ошибке бросает исключение.
+
+    Помимо суммы переходов и разбивки по странам возвращает ``days`` —
+    список пар (timestamp начала дня, переходы).
+    """
+    response = await vk_call(
+        "utils.getLinkStats",
+        {"key": key, "interval": "day", "intervals_count": STATS_HISTORY_DAYS, "extended": 1},
+        session,
+        priority
+    )
+    stats = empty_stats()
+    stats["days"] = []
+    if isinstance(response, dict) and 'stats' in response:
+        for day in response['stats']:
+            stats["views"] += day.get("views", 0)
+            if day.get("timestamp"):
+                stats["days"].append((day["timestamp"], day.get("views", 0)))
+            # extended=1 отдаёт список countries; поле country — старый формат
+            countries = day.get("countries") or []
+            if day.get("country"):
+                countries = [{"country_id": day["country"], "views": day.get("views", 0)}]
+            for country in countries:
+                country_id = country.get("country_id")
+                if country_id:
+                    stats["countries"][country_id] = stats["countries"].get(country_id, 0) + country.get("views", 0)
+    return stats
+
 async def get_link_stats(key, session):
-    params = {"access_token": VK_TOKEN, "key": key, "v": "5.199", "interval": "day", "extended": 1}
     try:
-        async with session.get(
-            "https://api.vk.com/method/utils.getLinkStats",
-            params=params,
-            timeout=5
-        ) as resp:
-            if resp.status != 200:
-                logger.error(f"VK API вернул статус {resp.status} для ключа {key}")
-                return {"views": 0, "countries": {}}
-            data = await resp.json()
-            stats = {"views": 0, "countries": {}}
-            if 'response' in data and 'stats' in data['response']:
-                for day in data['response']['stats']:
-                    stats["views"] += day.get("views", 0)
-                    country_id = day.get("country")
-                    if country_id:
-                        stats["countries"][country_id] = stats["countries"].get(country_id, 0) + day.get("views", 0)
-            return stats
+        return await fetch_link_stats(key, session)
     except Exception as e:
         logger.error(f"Ошибка получения статистики для ключа {key}: {e}")
-        return {"views": 0, "countries": {}}
+        return empty_stats()
+
+class StatsCache:
+    """LRU-кэш статистики по ключу ссылки VK с TTL и stale-while-revalidate.
+
+    Свежие данные отдаются из кэша, устаревшие — тоже сразу, но с фоновым
+    обновлением. Одновременные запросы одного ключа делят один запрос к VK.
+    """
+    def __init__(self, ttl=STATS_CACHE_TTL, max_size=STATS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (stats, fetched_at)
+        self._inflight = {}
+
+    def _store(self, key, stats):
+        self._entries[key] = (stats, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _refresh(self, key, session):
+        try:
+            stats = await fetch_link_stats(key, session)
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики для ключа {key}: {e}")
+            return None
+        finally:
+            self._inflight.pop(key, None)
+        self._store(key, stats)
+        return stats
+
+    def put(self, key, stats):
+        self._store(key, stats)
+
+    def _refresh_task(self, key, session):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._refresh(key, session))
+            self._inflight[key] = task
+        return task
+
+    async def get(self, key, session, force=False, fallback=True):
+        """Статистика ключа; если VK не ответил и кэша нет — empty_stats() или None при ``fallback=False``."""
+        entry = self._entries.get(key)
+        if entry is not None and not force:
+            self._entries.move_to_end(key)
+            stats, fetched_at = entry
+            if time.monotonic() - fetched_at >= self.ttl:
+                self._refresh_task(key, session)
+            return stats
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        stats = await asyncio.shield(self._refresh_task(key, session))
+        if stats is None:
+            if entry is not None:
+                return entry[0]
+            return empty_stats() if fallback else None
+        return stats
+
+stats_cache = StatsCache()
+
+# История статистики по дням
+class StatsHistory:
+    """Компактная история переходов по дням для каждой ссылки.
+
+    Для ключа хранится номер первого дня и array('I') с переходами за
+    каждый следующий день (не больше ``retention`` дней), последняя
+    разбивка по странам и время обновления. История сохраняется в JSON.
+    """
+    def __init__(self, file_name=STATS_HISTORY_FILE, retention=STATS_HISTORY_DAYS):
+        self.file_name = file_name
+        self.retention = retention
+        self._series = {}  # key -> [first_day, array('I'), countries, updated]
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.file_name, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+        except FileNotFoundError:
+            return
+        except (UnicodeDecodeError, ValueError) as e:
+            logger.error(f"Ошибка загрузки истории статистики: {e}")
+            return
+        for key, item in raw.items():
+            self._series[key] = [
+                item['first_day'],
+                array('I', item['views']),
+                {int(k): v for k, v in item.get('countries', {}).items()},
+                item.get('updated', 0),
+            ]
+
+    def _save(self, snapshot):
+        tmp_name = f"{self.file_name}.tmp"
+        try:
+            with open(tmp_name, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+            os.replace(tmp_name, self.file_name)
+        except OSError as e:
+            logger.error(f"Ошибка записи истории статистики: {e}")
+
+    async def save(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        snapshot = {
+            key: {"first_day": first_day, "views": views.tolist(), "countries": countries, "updated": updated}
+            for key, (first_day, views, countries, updated) in self._series.items()
+        }
+        await asyncio.to_thread(self._save, snapshot)
+
+    def record(self, key, stats):
+        """Вливает ответ fetch_link_stats в историю ключа."""
+        if 'days' not in stats:
+            return
+        today = int(time.time()) // 86400
+        first_day, views, _, _ = self._series.get(key, [today, array('I', [0]), None, 0])
+        last_day = max([today] + [ts // 86400 for ts, _ in stats['days']])
+        if last_day - first_day + 1 > len(views):
+            views.extend([0] * (last_day - first_day + 1 - len(views)))
+        for ts, day_views in stats['days']:
+            day = ts // 86400
+            if day >= first_day:
+                views[day - first_day] = day_views
+            else:
+                # День раньше начала ряда — сдвигаем начало
+                views[0:0] = array('I', [day_views] + [0] * (first_day - day - 1))
+                first_day = day
+        if len(views) > self.retention:
+            del views[:len(views) - self.retention]
+            first_day = last_day - self.retention + 1
+        self._series[key] = [first_day, views, dict(stats['countries']), time.time()]
+        self._dirty = True
+
+    def get(self, key, max_age=None):
+        """История ключа; None, если её нет или она старше ``max_age`` секунд."""
+        series = self._series.get(key)
+        if series is None:
+            return None
+        first_day, views, countries, updated = series
+        if max_age is not None and time.time() - updated > max_age:
+            return None
+        # Выравниваем ряд до сегодняшнего дня нулями
+        daily = views.tolist() + [0] * max(0, int(time.time()) // 86400 - (first_day + len(views) - 1))
+        daily = daily[-self.retention:]
+        return {"views": sum(daily), "countries": countries, "daily": daily, "updated": updated}
+
+    def forget(self, keys):
+        for key in list(self._series):
+            if key not in keys:
+                del self._series[key]
+                self._dirty = True
+
+    def discard(self, key):
+        if self._series.pop(key, None) is not None:
+            self._dirty = True
+
+stats_history = StatsHistory()
+
+def fresh_history(key):
+    """Локальная история ключа, пока её обновляет сборщик; иначе None — идём в stats_cache."""
+    if STATS_COLLECT_INTERVAL <= 0:
+        return None
+    return stats_history.get(key, max_age=max(STATS_CACHE_TTL, STATS_COLLECT_INTERVAL))
+
+class StatsCollector:
+    """Фоновое обновление статистики всех сохранённых ссылок с низким приоритетом."""
+    def __init__(self, interval=STATS_COLLECT_INTERVAL, concurrency=STATS_COLLECT_CONCURRENCY):
+        self.interval = interval
+        self.concurrency = concurrency
+        self._task = None
+
+    async def collect(self, session):
+        keys = await storage.all_link_keys()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        failed = 0
+
+        async def refresh(key):
+            nonlocal failed
+            async with semaphore:
+                try:
+                    stats = await fetch_link_stats(key, session, VK_PRIORITY_BACKGROUND)
+                except Exception as e:
+                    failed += 1
+                    logger.debug(f"Сборщик: ошибка статистики для ключа {key}: {e}")
+                    return
+            stats_history.record(key, stats)
+            stats_cache.put(key, stats)
+
+        started = time.monotonic()
+        await asyncio.gather(*(refresh(key) for key in keys))
+        stats_history.forget(keys)
+        await stats_history.save()
+        logger.info(
+            f"Сборщик статистики: обновлено {len(keys) - failed} из {len(keys)} ключей "
+            f"за {time.monotonic() - started:.1f} с"
+        )
+
+    async def _loop(self, session):
+        while True:
+            try:
+                await self.collect(session)
+            except Exception as e:
+                logger.error(f"Ошибка сборщика статистики: {str(type(e).__name__)} - {str(e)[:100]}")
+            await asyncio.sleep(self.interval)
+
+    def start(self, session):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop(session))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await stats_history.save()
+
+stats_collector = StatsCollector()
 
 # Получение названий стран
+UNKNOWN_COUNTRY = 'Неизвестная страна'
+
+class CountryResolver:
+    """Кэш названий стран VK, сохраняемый на диск.
+
+    Все отсутствующие в кэше страны запрашиваются одним вызовом
+    database.getCountriesById, поэтому в установившемся режиме обращений
+    к VK нет вовсе.
+    """
+    def __init__(self, file_name=COUNTRIES_FILE):
+        self.file_name = file_name
+        self.names = self._load()
+        self._lock = asyncio.Lock()
+
+    def _load(self):
+        try:
+            with open(self.file_name, 'r', encoding='utf-8') as f:
+                return {int(k): v for k, v in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+        except (UnicodeDecodeError, ValueError, AttributeError) as e:
+            logger.error(f"Ошибка загрузки кэша стран: {e}")
+            return {}
+
+    def _save(self, snapshot):
+        tmp_name = f"{self.file_name}.tmp"
+        try:
+            with open(tmp_name, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_name, self.file_name)
+        except OSError as e:
+            logger.error(f"Ошибка записи кэша стран: {e}")
+
+    @timed("get_country_name")
+    async def _fetch(self, country_ids, session):
+        ids = ",".join(str(i) for i in country_ids)
+        try:
+            response = await vk_call("database.getCountriesById", {"country_ids": ids}, session, VK_PRIORITY_STATS)
+            return {
+                int(item['id']): item.get('title') or item.get('name') or UNKNOWN_COUNTRY
+                for item in response or []
+            }
+        except Exception as e:
+            logger.error(f"Ошибка получения названий стран {ids}: {e}")
+            return {}
+
+    async def resolve(self, country_ids, session):
+        """Возвращает {country_id: название} для всех переданных стран."""
+        wanted = {int(i) for i in country_ids}
+        missing = wanted - self.names.keys()
+        if missing:
+            async with self._lock:
+                # Пока ждали блокировку, часть стран могли загрузить другие запросы
+                missing = wanted - self.names.keys()
+                if missing:
+                    fetched = await self._fetch(sorted(missing), session)
+                    if fetched:
+                        self.names.update(fetched)
+                        await asyncio.to_thread(self._save, dict(self.names))
+        return {i: self.names.get(i, UNKNOWN_COUNTRY) for i in wanted}
+
+country_resolver = CountryResolver()
+
 async def get_country_name(country_id, session):
-    try:
-        async with session.get(
-            f"https://api.vk.com/method/database.getCountriesById?country_ids={country_id}&v=5.199&access_token={VK_TOKEN}",
-            timeout=5
-        ) as resp:
-            if resp.status != 200:
-                logger.error(f"VK API вернул статус {resp.status} для country_id {country_id}")
-                return 'Неизвестная страна'
-            data = await resp.json()
-            if 'response' in data and data['response']:
-                return data['response'][0].get('name', 'Неизвестная страна')
-            return 'Неизвестная страна'
-    except Exception as e:
-        logger.error(f"Ошибка получения названия страны {country_id}: {e}")
-        return 'Неизвестная страна'
+    names = await country_resolver.resolve([country_id], session)
+    return names[int(country_id)]
+
+# Данные callback-кнопок
+class LinkRef(NamedTuple):
+    """Ссылка в данных кнопки: позиция в списке пользователя и ключ VK для сверки.
+
+    Если после удаления или добавления позиция сместилась, ссылка находится
+    по ключу.
+    """
+    index: int
+    key: str = ""
+
+    @classmethod
+    def of(cls, index, link):
+        return cls(index, link.get('key') or "")
+
+    @classmethod
+    def parse(cls, raw):
+        index, _, key = raw.partition(".")
+        return cls(int(index), key)
+
+    def __str__(self):
+        return f"{self.index}.{self.key}" if self.key else str(self.index)
+
+class CallbackRouter:
+    """Маршрутизация callback-кнопок одной выборкой из таблицы по действию.
+
+    Данные кнопки — ``1:код:арг1:арг2``: версия формата, короткий код
+    действия и аргументы, типы которых заданы при регистрации (``int``,
+    ``str`` или класс с методом ``parse``). Кнопки прежнего формата
+    (``link_stats:3``, ``stats``) в уже отправленных сообщениях
+    распознаются по старому имени действия.
+    """
+    VERSION = "1"
+    MAX_DATA = 64  # ограничение Telegram на callback_data, байт
+
+    def __init__(self):
+        self._routes = {}  # код -> (обработчик, {имя аргумента: тип})
+        self._legacy = {}  # старое имя -> код
+
+    def action(self, code, legacy=None, **arg_types):
+        def decorator(handler):
+            self._routes[code] = (handler, arg_types)
+            if legacy:
+                self._legacy[legacy] = code
+            return handler
+        return decorator
+
+    def pack(self, code, *args):
+        data = ":".join((self.VERSION, code, *map(str, args)))
+        if len(data.encode()) > self.MAX_DATA:
+            raise ValueError(f"Данные кнопки длиннее {self.MAX_DATA} байт: {data}")
+        return data
+
+    def _split(self, data):
+        parts = (data or "").split(":")
+        if parts[0] == self.VERSION and len(parts) > 1:
+            return parts[1], parts[2:]
+        return self._legacy.get(parts[0]), parts[1:]
+
+    def handler_for(self, data):
+        code, _ = self._split(data)
+        route = self._routes.get(code)
+        return route[0] if route else None
+
+    def unpack(self, data):
+        """Возвращает (обработчик, аргументы) или None для неизвестных данных."""
+        code, raw_args = self._split(data)
+        route = self._routes.get(code)
+        if route is None:
+            return None
+        handler, arg_types = route
+        if len(raw_args) != len(arg_types):
+            return None
+        try:
+            args = {
+                name: getattr(arg_type, "parse", arg_type)(raw)
+                for (name, arg_type), raw in zip(arg_types.items(), raw_args)
+            }
+        except ValueError:
+            return None
+        return handler, args
+
+callbacks = CallbackRouter()
+
+# Все нажатия кнопок проходят через один обработчик вместо цепочки фильтров
+@router.callback_query()
+async def route_callback(cb: types.CallbackQuery, **data):
+    route = callbacks.unpack(cb.data)
+    if route is None:
+        logger.warning(f"Неизвестные данные кнопки: {cb.data!r}")
+        await cb.answer()
+        return
+    handler, args = route
+    return await handler(cb, **data, **args)
+
+async def find_link(uid, ref):
+    """Возвращает (позиция, ссылка) по LinkRef или (None, None)."""
+    links = await storage.get_user_links(uid)
+    if 0 <= ref.index < len(links) and (not ref.key or links[ref.index].get('key') == ref.key):
+        return ref.index, links[ref.index]
+    if ref.key:
+        for index, link in enumerate(links):
+            if link.get('key') == ref.key:
+                return index, link
+    return None, None
 
 # Создание клавиатуры
 def make_kb(buttons, row=2):
@@ -239,28 +2103,48 @@ def make_kb(buttons, row=2):
 # Главное меню
 def get_main_menu():
     return make_kb([
-        InlineKeyboardButton(text="🔗 Сократить ссылку", callback_data="add_link"),
-        InlineKeyboardButton(text="📊 Статистика", callback_data="stats"),
+        InlineKeyboardButton(text="🔗 Сократить ссылку", callback_data=callbacks.pack("add")),
+        InlineKeyboardButton(text="📊 Статистика", callback_data=callbacks.pack("stats")),
+        InlineKeyboardButton(text="📥 Импорт списка", callback_data=callbacks.pack("bulk")),
     ])
 
+BULK_PROMPT = (
+    "📥 Отправьте ссылки по одной в строке в формате url,название "
+    "(название необязательно) или файл .txt/.csv"
+)
+
+# Спарклайн переходов на экране статистики
+SPARK_BARS = "▁▂▃▄▅▆▇█"
+SPARK_DAYS = 14
+
 # Клавиатура отмены
-cancel_kb = make_kb([InlineKeyboardButton(text="🚫 Отмена", callback_data="cancel")])
+cancel_kb = make_kb([InlineKeyboardButton(text="🚫 Отмена", callback_data=callbacks.pack("cancel"))])
 
 # Декоратор обработки ошибок
 def handle_error(handler):
+    # Параметры обработчика разбираем один раз, а не на каждом апдейте
+    parameters = inspect.signature(handler).parameters
+    accepts_any = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in parameters.values())
+    accepted = frozenset(parameters)
+
     @wraps(handler)
     async def wrapper(*args, **kwargs):
         try:
-            sig = inspect.signature(handler)
-            filtered_kwargs = {k: v for k, v in kwargs.items() if k in sig.parameters}
-            return await handler(*args, **filtered_kwargs)
+            if not accepts_any:
+                kwargs = {k: v for k, v in kwargs.items() if k in accepted}
+            return await handler(*args, **kwargs)
         except Exception as e:
+            metrics.inc("bot_handler_errors_total", handler=handler.__name__, kind=type(e).__name__)
             logger.error(f"Ошибка в {handler.__name__}: {str(type(e).__name__)} - {str(e)[:100]}")
             text = "❌ Произошла ошибка. Пожалуйста, попробуйте позже или обратитесь к администратору."
             reply = get_main_menu()
             if isinstance(args[0], types.CallbackQuery):
                 await args[0].message.edit_text(text, reply_markup=reply)
-                await args[0].answer()
+                try:
+                    await args[0].answer()
+                except TelegramBadRequest:
+                    # Обработчик мог ответить на нажатие до ошибки (show_dashboard — сразу)
+                    pass
             elif isinstance(args[0], types.Message):
                 await args[0].answer(text, reply_markup=reply)
     return wrapper
@@ -284,18 +2168,20 @@ async def cmd_help(message: types.Message, state: FSMContext):
         "ℹ️ Помощь по боту:\n\n"
         "/start — начать работу\n"
         "/help — показать эту справку\n"
+        "/import — импортировать список ссылок\n"
+        "/export csv|json — выгрузить ссылки со статистикой\n"
         "🔗 Используйте кнопки для сокращения ссылок и просмотра статистики",
         reply_markup=get_main_menu()
     )
 
-@router.callback_query(lambda c: c.data == "cancel")
+@callbacks.action("cancel", legacy="cancel")
 @handle_error
 async def cancel_action(cb: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await cb.message.edit_text("✅ Отменено", reply_markup=get_main_menu())
     await cb.answer()
 
-@router.callback_query(lambda c: c.data == "add_link")
+@callbacks.action("add", legacy="add_link")
 @handle_error
 async def add_link(cb: types.CallbackQuery, state: FSMContext):
     await state.clear()
@@ -310,18 +2196,23 @@ async def add_link(cb: types.CallbackQuery, state: FSMContext):
 @handle_error
 async def process_link(message: types.Message, state: FSMContext, vk_session: aiohttp.ClientSession):
     url = message.text.strip()
-    if not await is_valid_url(url, vk_session):
-        await message.answer(
-            "❌ Неверный URL. Убедитесь, что он начинается с http:// или https:// и доступен.\nПример: https://example.com",
-            reply_markup=cancel_kb
-        )
-        return
-    loading_msg = await message.answer('⏳ Сокращаю...')
-    short_url, key, error_msg = await shorten_link_vk(url, vk_session)
-    await loading_msg.delete()
-    if not short_url:
-        await message.answer(f"❌ {error_msg}", reply_markup=cancel_kb)
-        return
+    cached = await short_index.get(url)
+    if cached:
+        short_url, key = cached
+    else:
+        if not await is_valid_url(url, vk_session):
+            await message.answer(
+                "❌ Неверный URL. Убедитесь, что он начинается с http:// или https:// и доступен.\nПример: https://example.com",
+                reply_markup=cancel_kb
+            )
+            return
+        loading_msg = await message.answer('⏳ Сокращаю...')
+        short_url, key, error_msg = await shorten_link_vk(url, vk_session)
+        await loading_msg.delete()
+        if not short_url:
+            await message.answer(f"❌ {error_msg}", reply_markup=cancel_kb)
+            return
+        await short_index.put(url, short_url, key)
     await state.update_data(original=url, short=short_url, key=key)
     await message.answer("📝 Введите название для ссылки (до 100 символов):", reply_markup=cancel_kb)
     await state.set_state(LinkForm.waiting_for_title)
@@ -342,7 +2233,7 @@ async def process_title(message: types.Message, state: FSMContext):
         "key": data['key'],
         "created": datetime.now().isoformat()
     }
-    if not storage.add_link(uid, link_data):
+    if not await storage.add_link(uid, link_data):
         await message.answer("❌ Эта ссылка уже сохранена.", reply_markup=get_main_menu())
         await state.clear()
         return
@@ -353,13 +2244,13 @@ async def process_title(message: types.Message, state: FSMContext):
     )
     await state.clear()
 
-@router.callback_query(lambda c: c.data == "stats")
+@callbacks.action("stats", legacy="stats")
 @handle_error
 async def stats_menu(cb: types.CallbackQuery, state: FSMContext):
     await state.clear()
     uid = str(cb.from_user.id)
     logger.info(f"Запрос статистики от user_id: {uid}")
-    links = storage.get_user_links(uid)
+    links = await storage.get_user_links(uid)
     logger.info(f"Ссылки пользователя {uid}: {[link['title'] for link in links]}")
     if not links:
         logger.info(f"У пользователя {uid} нет сохранённых ссылок")
@@ -368,98 +2259,145 @@ async def stats_menu(cb: types.CallbackQuery, state: FSMContext):
         return
     ITEMS_PER_PAGE = 10
     buttons = [
-        InlineKeyboardButton(text=f"{link['title']} ({link['short']})", callback_data=f"link_stats:{i}")
+        InlineKeyboardButton(text=f"{link['title']} ({link['short']})", callback_data=callbacks.pack("ls", LinkRef.of(i, link)))
         for i, link in enumerate(links[:ITEMS_PER_PAGE])
     ]
     if len(links) > ITEMS_PER_PAGE:
-        buttons.append(InlineKeyboardButton(text="➡️ Далее", callback_data="stats_next:1"))
-    buttons.append(InlineKeyboardButton(text="🚫 Отмена", callback_data="cancel"))
+        buttons.append(InlineKeyboardButton(text="➡️ Далее", callback_data=callbacks.pack("page", 1)))
+    buttons.append(InlineKeyboardButton(text="📈 Сводка по всем ссылкам", callback_data=callbacks.pack("dash")))
+    buttons.append(InlineKeyboardButton(text="📤 Экспорт CSV", callback_data=callbacks.pack("export", "csv")))
+    buttons.append(InlineKeyboardButton(text="📤 Экспорт JSON", callback_data=callbacks.pack("export", "json")))
+    buttons.append(InlineKeyboardButton(text="🚫 Отмена", callback_data=callbacks.pack("cancel")))
     kb = make_kb(buttons, row=1)
     await cb.message.edit_text("📊 Выберите ссылку для просмотра статистики:", reply_markup=kb)
     await state.set_state(LinkForm.waiting_for_link_action)
     await cb.answer()
 
-@router.callback_query(lambda c: c.data.startswith("stats_next:"))
+@callbacks.action("page", legacy="stats_next", page=int)
 @handle_error
-async def stats_next_page(cb: types.CallbackQuery, state: FSMContext):
-    page = int(cb.data.split(":")[1])
+async def stats_next_page(cb: types.CallbackQuery, state: FSMContext, page: int):
     uid = str(cb.from_user.id)
-    links = storage.get_user_links(uid)
+    links = await storage.get_user_links(uid)
     ITEMS_PER_PAGE = 10
     start = page * ITEMS_PER_PAGE
     end = start + ITEMS_PER_PAGE
     buttons = [
-        InlineKeyboardButton(text=f"{link['title']} ({link['short']})", callback_data=f"link_stats:{i}")
-        for i, link in enumerate(links[start:end])
+        InlineKeyboardButton(text=f"{link['title']} ({link['short']})", callback_data=callbacks.pack("ls", LinkRef.of(i, link)))
+        for i, link in enumerate(links[start:end], start)
     ]
     if start > 0:
-        buttons.append(InlineKeyboardButton(text="⬅ Назад", callback_data=f"stats_next:{page-1}"))
+        buttons.append(InlineKeyboardButton(text="⬅ Назад", callback_data=callbacks.pack("page", page - 1)))
     if end < len(links):
-        buttons.append(InlineKeyboardButton(text="➡️ Далее", callback_data=f"stats_next:{page+1}"))
-    buttons.append(InlineKeyboardButton(text="🚫 Отмена", callback_data="cancel"))
+        buttons.append(InlineKeyboardButton(text="➡️ Далее", callback_data=callbacks.pack("page", page + 1)))
+    buttons.append(InlineKeyboardButton(text="🚫 Отмена", callback_data=callbacks.pack("cancel")))
     kb = make_kb(buttons, row=1)
     await cb.message.edit_text(f"📊 Выберите ссылку для просмотра статистики (страница {page+1}):", reply_markup=kb)
     await cb.answer()
 
-@router.callback_query(lambda c: c.data.startswith("link_stats:"))
-@handle_error
-async def show_link_stats(cb: types.CallbackQuery, state: FSMContext, vk_session: aiohttp.ClientSession):
-    link_index = int(cb.data.split(":")[1])
-    uid = str(cb.from_user.id)
-    links = storage.get_user_links(uid)
-    if not (0 <= link_index < len(links)):
-        await cb.message.edit_text("❌ Ссылка не найдена", reply_markup=get_main_menu())
-        await state.clear()
-        await cb.answer()
-        return
-    link = links[link_index]
-    loading_msg = await cb.message.edit_text('⏳ Загружаем статистику...')
-    stats = await get_link_stats(link['key'], vk_session)
-    text = f"📊 Статистика для '{link['title']}'\n\n"
+def sparkline(values):
+    if not values or max(values) == 0:
+        return SPARK_BARS[0] * len(values)
+    top = max(values)
+    return "".join(SPARK_BARS[min(len(SPARK_BARS) - 1, v * len(SPARK_BARS) // (top + 1))] for v in values)
+
+def format_trend(daily):
+    if len(daily) < 2:
+        return ""
+    today, yesterday = daily[-1], daily[-2]
+    if yesterday:
+        change = f"{(today - yesterday) * 100 / yesterday:+.0f}%"
+    else:
+        change = "новые" if today else "без изменений"
+    arrow = "📈" if today > yesterday else "📉" if today < yesterday else "➖"
+    return f"{arrow} Сегодня: {today}, вчера: {yesterday} ({change})\n"
+
+async def render_link_stats(link, view, session):
+    text = f"📊 Статистика для '{html.escape(link['title'])}'\n\n"
     text += f"🔗 Короткая ссылка: {link['short']}\n"
-    text += f"🌐 Оригинальная ссылка: {link['original']}\n"
-    text += f"👁 Переходы: {stats['views']}\n"
-    if stats['countries']:
+    text += f"🌐 Оригинальная ссылка: {html.escape(link['original'])}\n"
+    text += f"👁 Переходы: {view['views']}\n"
+    daily = view.get('daily')
+    if daily:
+        text += format_trend(daily)
+        text += f"📅 {len(daily[-SPARK_DAYS:])} дн.: {sparkline(daily[-SPARK_DAYS:])}\n"
+    if view['countries']:
         text += "\n🌍 Геолокация (по странам):\n"
-        for country_id, views in stats['countries'].items():
-            country_name = await get_country_name(country_id, vk_session)
-            text += f"{country_name}: {views} переходов\n"
+        country_names = await country_resolver.resolve(view['countries'].keys(), session)
+        for country_id, views in sorted(view['countries'].items(), key=lambda item: -item[1]):
+            text += f"{country_names[int(country_id)]}: {views} переходов\n"
     else:
         text += "\n🌍 Геолокация: данные отсутствуют\n"
+    if view.get('updated'):
+        text += f"\n🕒 Обновлено: {datetime.fromtimestamp(view['updated']).strftime('%d.%m %H:%M')}\n"
+    return text
+
+async def show_stats(cb, state, vk_session, ref, live):
+    link_index, link = await find_link(str(cb.from_user.id), ref)
+    if link is None:
+        await cb.message.edit_text("❌ Ссылка не найдена", reply_markup=get_main_menu())
+        await state.clear()
+        await cb.answer()
+        return
+    ref = LinkRef.of(link_index, link)
+    # Обычно показываем локальную историю сборщика — мгновенно и без запросов к VK
+    view = None if live else fresh_history(link['key'])
+    if view is None:
+        await cb.message.edit_text('⏳ Загружаем статистику...')
+        stats = await stats_cache.get(link['key'], vk_session, force=live)
+        stats_history.record(link['key'], stats)
+        view = stats_history.get(link['key']) or stats
+    text = await render_link_stats(link, view, vk_session)
     buttons = [
-        InlineKeyboardButton(text="⬅ Назад к списку", callback_data="stats"),
-        InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_link:{link_index}"),
-        InlineKeyboardButton(text="✏ Переименовать", callback_data=f"rename_link:{link_index}")
+        InlineKeyboardButton(text="🔄 Обновить", callback_data=callbacks.pack("live", ref)),
+        InlineKeyboardButton(text="⬅ Назад к списку", callback_data=callbacks.pack("stats")),
+        InlineKeyboardButton(text="🗑 Удалить", callback_data=callbacks.pack("del", ref)),
+        InlineKeyboardButton(text="✏ Переименовать", callback_data=callbacks.pack("ren", ref))
     ]
     kb = make_kb(buttons, row=1)
-    await loading_msg.delete()
-    await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    try:
+        await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    except TelegramBadRequest as e:
+        # Повторное обновление без изменений — не ошибка
+        if "message is not modified" not in str(e):
+            raise
     await cb.answer()
 
-@router.callback_query(lambda c: c.data.startswith("delete_link:"))
+@callbacks.action("ls", legacy="link_stats", link=LinkRef)
+@handle_error
+async def show_link_stats(cb: types.CallbackQuery, state: FSMContext, vk_session: aiohttp.ClientSession, link: LinkRef):
+    await show_stats(cb, state, vk_session, link, live=False)
+
+@callbacks.action("live", legacy="link_stats_live", link=LinkRef)
+@handle_error
+async def refresh_link_stats(cb: types.CallbackQuery, state: FSMContext, vk_session: aiohttp.ClientSession, link: LinkRef):
+    await show_stats(cb, state, vk_session, link, live=True)
+
+@callbacks.action("del", legacy="delete_link", link=LinkRef)
 @handle_error
-async def delete_link(cb: types.CallbackQuery, state: FSMContext):
-    link_index = int(cb.data.split(":")[1])
+async def delete_link(cb: types.CallbackQuery, state: FSMContext, link: LinkRef):
     uid = str(cb.from_user.id)
-    if storage.delete_link(uid, link_index):
+    link_index, found = await find_link(uid, link)
+    if link_index is not None and await storage.delete_link(uid, link_index):
+        # Сборщик чистит историю сам, но он может быть выключен; ключ бывает общим у разных ссылок
+        key = found.get('key')
+        if key and key not in await storage.all_link_keys():
+            stats_history.discard(key)
         await cb.message.edit_text("✅ Ссылка удалена", reply_markup=get_main_menu())
     else:
         await cb.message.edit_text("❌ Ошибка удаления ссылки", reply_markup=get_main_menu())
     await state.clear()
     await cb.answer()
 
-@router.callback_query(lambda c: c.data.startswith("rename_link:"))
+@callbacks.action("ren", legacy="rename_link", link=LinkRef)
 @handle_error
-async def rename_link(cb: types.CallbackQuery, state: FSMContext):
-    link_index = int(cb.data.split(":")[1])
-    uid = str(cb.from_user.id)
-    links = storage.get_user_links(uid)
-    if not (0 <= link_index < len(links)):
+async def rename_link(cb: types.CallbackQuery, state: FSMContext, link: LinkRef):
+    link_index, found = await find_link(str(cb.from_user.id), link)
+    if found is None:
         await cb.message.edit_text("❌ Ссылка не найдена", reply_markup=get_main_menu())
         await state.clear()
         await cb.answer()
         return
-    await state.update_data(link_index=link_index)
+    await state.update_data(link_index=link_index, link_key=found.get('key') or "")
     await cb.message.edit_text("✏ Введите новое название для ссылки (до 100 символов):", reply_markup=cancel_kb)
     await state.set_state(LinkForm.waiting_for_rename)
     await cb.answer()
@@ -472,10 +2410,10 @@ async def process_rename(message: types.Message, state: FSMContext):
         await message.answer("❌ Название не может быть пустым:", reply_markup=cancel_kb)
         return
     data = await state.get_data()
-    link_index = data.get("link_index")
     uid = str(message.from_user.id)
-    if storage.rename_link(uid, link_index, new_title):
-        links = storage.get_user_links(uid)
+    link_index, _ = await find_link(uid, LinkRef(data.get("link_index", -1), data.get("link_key", "")))
+    if link_index is not None and await storage.rename_link(uid, link_index, new_title):
+        links = await storage.get_user_links(uid)
         link = links[link_index]
         await message.answer(
             f"✅ Ссылка переименована:\n<b>{new_title}</b>\n{link['short']}",
@@ -486,30 +2424,695 @@ async def process_rename(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка переименования ссылки", reply_markup=get_main_menu())
     await state.clear()
 
+# Массовый импорт ссылок
+def parse_bulk_rows(text):
+    """Разбирает строки вида ``url[,название]``; возвращает (строки, всего строк)."""
+    rows = []
+    for record in csv.reader(io.StringIO(text)):
+        if not record or not record[0].strip():
+            continue
+        url = record[0].strip()
+        if not rows and url.lower() == "url":  # заголовок CSV
+            continue
+        title = ",".join(record[1:]).strip()[:100]
+        rows.append((url, title))
+    return rows[:BULK_MAX_ROWS], len(rows)
+
+def default_title(url):
+    parsed = urlparse(url)
+    return (parsed.netloc + parsed.path).rstrip("/")[:100] or url[:100]
+
+async def shorten_cached(url, session, priority=VK_PRIORITY_INTERACTIVE):
+    """Сокращение с учётом общего индекса ссылок."""
+    cached = await short_index.get(url)
+    if cached:
+        return cached[0], cached[1], ""
+    short_url, key, error_msg = await shorten_link_vk(url, session, priority)
+    if short_url:
+        await short_index.put(url, short_url, key)
+    return short_url, key, error_msg
+
+async def edit_progress(msg, text, reply_markup=None):
+    try:
+        await msg.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest:
+        # Текст не изменился или сообщение удалено — прогресс не критичен
+        pass
+
+async def run_bulk_import(user_id, rows, status_msg, session):
+    """Проверяет и сокращает ссылки с ограниченным параллелизмом и сохраняет их одной пачкой."""
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    results = [None] * len(rows)
+    done = 0
+    last_report = time.monotonic()
+
+    async def process(i, url, title):
+        nonlocal done, last_report
+        async with semaphore:
+            try:
+                short_url, key, error_msg = await shorten_cached(url, session, VK_PRIORITY_BACKGROUND)
+            except Exception as e:
+                # Ошибка одной строки не должна обрывать импорт остальных
+                logger.error(f"Ошибка импорта {sanitize_url(url)}: {type(e).__name__} - {str(e)[:100]}")
+                short_url, key, error_msg = None, None, "Внутренняя ошибка при обработке ссылки"
+        results[i] = (url, title, short_url, key, error_msg)
+        done += 1
+        if time.monotonic() - last_report >= BULK_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await edit_progress(status_msg, f"⏳ Импорт: обработано {done} из {len(rows)}...")
+
+    await asyncio.gather(*(process(i, url, title) for i, (url, title) in enumerate(rows)))
+    links, failures = [], []
+    for url, title, short_url, key, error_msg in results:
+        if not short_url:
+            failures.append((url, error_msg))
+            continue
+        links.append({
+            "title": title or default_title(url),
+            "short": short_url,
+            "original": url,
+            "key": key,
+            "created": datetime.now().isoformat()
+        })
+    added, duplicates = await storage.add_links(user_id, links) if links else ([], [])
+    return added, duplicates, failures
+
+def format_bulk_summary(added, duplicates, failures, skipped):
+    text = "✅ Импорт завершён\n\n"
+    text += f"Добавлено: {len(added)}\nУже были сохранены: {len(duplicates)}\nОшибки: {len(failures)}\n"
+    if skipped:
+        text += f"Пропущено сверх лимита в {BULK_MAX_ROWS} строк: {skipped}\n"
+    sections = [
+        ("\n✅ Добавлены:", [f"{link['title']} — {link['short']}" for link in added]),
+        ("\n♻️ Дубликаты:", [link['original'] for link in duplicates]),
+        ("\n❌ Не удалось:", [f"{sanitize_url(url)} — {error}" for url, error in failures]),
+    ]
+    for header, lines in sections:
+        if not lines:
+            continue
+        text += header + "\n"
+        text += "\n".join(lines[:BULK_SUMMARY_LINES]) + "\n"
+        if len(lines) > BULK_SUMMARY_LINES:
+            text += f"...и ещё {len(lines) - BULK_SUMMARY_LINES}\n"
+    # Ограничение Telegram на длину сообщения
+    return text[:4000]
+
+@router.message(Command("import"))
+@handle_error
+async def cmd_import(message: types.Message, state: FSMContext):
+    await state.clear()
+    await message.answer(BULK_PROMPT, reply_markup=cancel_kb)
+    await state.set_state(LinkForm.waiting_for_bulk)
+
+@callbacks.action("bulk", legacy="bulk_import")
+@handle_error
+async def bulk_import(cb: types.CallbackQuery, state: FSMContext):
+    await state.clear()
+    await cb.message.edit_text(BULK_PROMPT, reply_markup=cancel_kb)
+    await state.set_state(LinkForm.waiting_for_bulk)
+    await cb.answer()
+
+@router.message(StateFilter(LinkForm.waiting_for_bulk))
+@handle_error
+async def process_bulk(message: types.Message, state: FSMContext, vk_session: aiohttp.ClientSession):
+    if message.document:
+        name = (message.document.file_name or "").lower()
+        if not name.endswith((".txt", ".csv")):
+            await message.answer("❌ Поддерживаются только файлы .txt и .csv", reply_markup=cancel_kb)
+            return
+        if (message.document.file_size or 0) > BULK_MAX_FILE_SIZE:
+            await message.answer("❌ Файл слишком большой", reply_markup=cancel_kb)
+            return
+        buffer = await message.bot.download(message.document, destination=io.BytesIO())
+        text = buffer.getvalue().decode("utf-8-sig", errors="replace")
+    else:
+        text = message.text or ""
+    try:
+        rows, total = parse_bulk_rows(text)
+    except csv.Error as e:
+        logger.warning(f"Некорректный CSV от пользователя {message.from_user.id}: {e}")
+        await message.answer("❌ Не удалось разобрать CSV: файл повреждён или в неверном формате", reply_markup=cancel_kb)
+        return
+    if not rows:
+        await message.answer("❌ Не найдено ни одной ссылки. " + BULK_PROMPT, reply_markup=cancel_kb)
+        return
+    await state.clear()
+    uid = str(message.from_user.id)
+    logger.info(f"Импорт {len(rows)} ссылок от пользователя {uid}")
+    status_msg = await message.answer(f"⏳ Импорт: обработано 0 из {len(rows)}...")
+    added, duplicates, failures = await run_bulk_import(uid, rows, status_msg, vk_session)
+    summary = format_bulk_summary(added, duplicates, failures, total - len(rows))
+    await edit_progress(status_msg, summary, reply_markup=get_main_menu())
+
+# Сводка по всем ссылкам пользователя
+def start_stats_fetches(links, session, limit, fallback=True):
+    """Запускает получение статистики всех ссылок сразу, не больше ``limit`` одновременно.
+
+    С ``fallback=False`` задача ссылки, статистику которой получить не удалось,
+    возвращает None вместо нулевой статистики.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def fetch(link):
+        if not link.get('key'):
+            return empty_stats()
+        async with semaphore:
+            return await stats_cache.get(link['key'], session, fallback=fallback)
+
+    return [asyncio.create_task(fetch(link)) for link in links]
+
+async def collect_dashboard(links, session):
+    """Собирает статистику всех ссылок за бюджет времени.
+
+    Ссылки с локальной историей считаются сразу, остальные запрашиваются
+    параллельно (не больше DASHBOARD_CONCURRENCY одновременно). Всё, что не
+    успело за DASHBOARD_BUDGET секунд или завершилось ошибкой, попадает в
+    ``missing``. Опоздавшие запросы не отменяются: они дорабатывают в фоне и
+    кладут результат в stats_cache к следующему открытию сводки.
+    """
+    results, to_fetch = [], []
+    for link in links:
+        view = fresh_history(link['key']) if link.get('key') else None
+        if view is not None:
+            results.append((link, view))
+        elif link.get('key'):
+            to_fetch.append(link)
+    missing = []
+    if to_fetch:
+        tasks = start_stats_fetches(to_fetch, session, DASHBOARD_CONCURRENCY, fallback=False)
+        await asyncio.wait(tasks, timeout=DASHBOARD_BUDGET)
+        for link, task in zip(to_fetch, tasks):
+            stats = task.result() if task.done() else None
+            if stats is not None:
+                results.append((link, stats))
+            else:
+                missing.append(link)
+    return results, missing
+
+async def render_dashboard(links, results, missing, session):
+    total = sum(stats['views'] for _, stats in results)
+    countries = {}
+    for _, stats in results:
+        for country_id, views in stats['countries'].items():
+            countries[int(country_id)] = countries.get(int(country_id), 0) + views
+    text = "📈 Сводка по всем ссылкам\n\n"
+    text += f"🔗 Ссылок: {len(links)}\n"
+    text += f"👁 Всего переходов: {total}\n"
+    top = sorted(results, key=lambda item: -item[1]['views'])[:DASHBOARD_TOP]
+    if top:
+        text += "\n🏆 Популярные ссылки:\n"
+        for i, (link, stats) in enumerate(top, 1):
+            text += f"{i}. {html.escape(link['title'])} — {stats['views']}\n"
+    if countries:
+        text += "\n🌍 Страны:\n"
+        # Названия всех стран — одним запросом
+        names = await country_resolver.resolve(countries.keys(), session)
+        for country_id, views in sorted(countries.items(), key=lambda item: -item[1])[:DASHBOARD_TOP]:
+            text += f"{names[country_id]}: {views}\n"
+    if missing:
+        text += f"\n⚠️ Нет данных по {len(missing)} ссылкам — VK не ответил, обновите позже\n"
+    return text
+
+@callbacks.action("dash", legacy="dashboard")
+@handle_error
+async def show_dashboard(cb: types.CallbackQuery, state: FSMContext, vk_session: aiohttp.ClientSession):
+    uid = str(cb.from_user.id)
+    links = await storage.get_user_links(uid)
+    if not links:
+        await cb.message.edit_text("📋 У вас нет сохранённых ссылок", reply_markup=get_main_menu())
+        await cb.answer()
+        return
+    await cb.answer("⏳ Считаем...")
+    results, missing = await collect_dashboard(links, vk_session)
+    text = await render_dashboard(links, results, missing, vk_session)
+    kb = make_kb([
+        InlineKeyboardButton(text="🔄 Обновить", callback_data=callbacks.pack("dash")),
+        InlineKeyboardButton(text="⬅ Назад к списку", callback_data=callbacks.pack("stats")),
+    ], row=1)
+    try:
+        await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+
+# Экспорт ссылок со статистикой
+EXPORT_FIELDS = ["title", "short", "original", "created", "views", "countries"]
+
+async def build_export(links, fmt, session):
+    """Строит файл экспорта; возвращает (содержимое, число ссылок без статистики).
+
+    Статистика всех ссылок запрашивается параллельно, строки пишутся после
+    её получения. Одновременно в работе не больше EXPORT_CONCURRENCY
+    запросов, поэтому в один execute попадает не больше EXPORT_CONCURRENCY
+    вызовов: 50 ссылок при значении 10 — около 5 последовательных запросов
+    к VK. У ссылок, по которым VK не ответил, views пустое (null).
+    """
+    tasks = start_stats_fetches(links, session, EXPORT_CONCURRENCY, fallback=False)
+    all_stats = await asyncio.gather(*tasks)
+    failed = sum(stats is None for stats in all_stats)
+    # Названия всех стран — одним запросом
+    country_ids = {country_id for stats in all_stats if stats for country_id in stats['countries']}
+    names = await country_resolver.resolve(country_ids, session) if country_ids else {}
+    buffer = io.StringIO()
+    if fmt == "csv":
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+    else:
+        buffer.write("[\n")
+    for i, (link, stats) in enumerate(zip(links, all_stats)):
+        countries = {names[int(cid)]: views for cid, views in stats['countries'].items()} if stats else {}
+        row = {
+            "title": link['title'],
+            "short": link['short'],
+            "original": link['original'],
+            "created": link.get('created', ''),
+            "views": stats['views'] if stats else None,
+        }
+        if fmt == "csv":
+            row["countries"] = "; ".join(f"{name}: {views}" for name, views in countries.items())
+            writer.writerow(row)
+        else:
+            row["countries"] = countries
+            buffer.write(("  " if i == 0 else ",\n  ") + json.dumps(row, ensure_ascii=False))
+    if fmt != "csv":
+        buffer.write("\n]\n")
+    # BOM, чтобы Excel корректно открыл CSV в UTF-8
+    return buffer.getvalue().encode("utf-8-sig" if fmt == "csv" else "utf-8"), failed
+
+async def send_export(message, user_id, fmt, session):
+    links = await storage.get_user_links(user_id)
+    if not links:
+        await message.answer("📋 У вас нет сохранённых ссылок", reply_markup=get_main_menu())
+        return
+    status_msg = await message.answer(f"⏳ Готовим экспорт {len(links)} ссылок...")
+    data, failed = await build_export(links, fmt, session)
+    file_name = f"links_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}"
+    caption = f"📤 Экспорт: {len(links)} ссылок"
+    if failed:
+        caption += f"\n⚠️ Нет статистики по {failed} ссылкам — VK не ответил, поле views пустое"
+    await message.answer_document(
+        BufferedInputFile(data, filename=file_name),
+        caption=caption,
+        reply_markup=get_main_menu()
+    )
+    await status_msg.delete()
+
+@router.message(Command("export"))
+@handle_error
+async def cmd_export(message: types.Message, state: FSMContext, command: CommandObject, vk_session: aiohttp.ClientSession):
+    await state.clear()
+    fmt = (command.args or "csv").strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        await message.answer("❌ Формат экспорта: /export csv или /export json", reply_markup=get_main_menu())
+        return
+    await send_export(message, str(message.from_user.id), fmt, vk_session)
+
+@callbacks.action("export", legacy="export", fmt=str)
+@handle_error
+async def export_links(cb: types.CallbackQuery, state: FSMContext, vk_session: aiohttp.ClientSession, fmt: str):
+    await state.clear()
+    if fmt not in EXPORT_FORMATS:
+        await cb.answer()
+        return
+    await cb.answer("⏳ Готовим файл...")
+    await send_export(cb.message, str(cb.from_user.id), fmt, vk_session)
+
+# Шардирование по пользователям
+def shard_of(user_id, count=SHARD_COUNT):
+    return int(user_id) % count
+
+def shard_path(path, index):
+    """links.json -> links.shard0.json: у каждого воркера свои файлы данных."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+def shard_socket(index):
+    return os.path.join(SHARD_SOCKET_DIR, f"shard{index}.sock")
+
+def saved_shard_count():
+    """Число шардов, на которое уже разложено хранилище (None — не разложено)."""
+    marker = f"{LINKS_DB if STORAGE_BACKEND == 'sqlite' else LINKS_FILE}.shards"
+    if not os.path.exists(marker):
+        return None
+    with open(marker, encoding="utf-8") as f:
+        return int(f.read().strip() or 0)
+
+def check_shard_count(count=SHARD_COUNT):
+    """Прерывает запуск, если хранилище разложено на другое число шардов.
+
+    Иначе пользователи попали бы не в свои шарды, а без шардирования бот
+    работал бы со старым общим файлом, и изменения из шардов пропали бы.
+    """
+    saved = saved_shard_count()
+    if saved is not None and saved != count:
+        raise ValueError(f"Данные разбиты на {saved} шардов, а SHARD_COUNT={count}: сначала объедините шарды")
+
+def split_into_shards(count=SHARD_COUNT):
+    """Раскладывает ссылки общего хранилища по файлам шардов при первом запуске.
+
+    Число шардов запоминается рядом с хранилищем (см. check_shard_count).
+    """
+    base = LINKS_DB if STORAGE_BACKEND == "sqlite" else LINKS_FILE
+    marker = f"{base}.shards"
+    check_shard_count(count)
+    if os.path.exists(marker):
+        return
+    if STORAGE_BACKEND == "sqlite":
+        for index in range(count):
+            conn = sqlite3.connect(shard_path(LINKS_DB, index))
+            try:
+                conn.executescript(SqliteStorage.SCHEMA)
+                if os.path.exists(LINKS_DB):
+                    conn.execute("ATTACH DATABASE ? AS base", (LINKS_DB,))
+                    with conn:
+                        conn.execute(
+                            "INSERT OR IGNORE INTO links (user_id, title, short, original, key, created) "
+                            "SELECT user_id, title, short, original, key, created FROM base.links "
+                            "WHERE CAST(user_id AS INTEGER) % ? = ?",
+                            (count, index)
+                        )
+            finally:
+                conn.close()
+    else:
+        data = storage.data
+        shards = [{} for _ in range(count)]
+        for uid, links in data.items():
+            shards[shard_of(uid, count)][uid] = links
+        for index, shard in enumerate(shards):
+            path = shard_path(LINKS_FILE, index)
+            if os.path.exists(path):
+                continue
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(shard, f, ensure_ascii=False, indent=2)
+            os.replace(f"{path}.tmp", path)
+    with open(marker, "w", encoding="utf-8") as f:
+        f.write(str(count))
+    logger.info(f"Хранилище {base} разложено на {count} шардов")
+
+class ShardRouterMiddleware(BaseMiddleware):
+    """Outer-middleware входного процесса: вместо обработки отправляет апдейт
+    воркеру шарда его пользователя (JSON, одна строка на апдейт).
+
+    У каждого шарда своя очередь и своя фоновая задача отправки: все апдейты
+    пользователя идут через одно соединение в исходном порядке, а упавший
+    воркер не задерживает приём апдейтов остальных шардов. Пока воркер
+    перезапускается, его апдейты копятся в очереди (не больше ``buffer_size``,
+    лишние отбрасываются).
+    """
+    def __init__(self, count=SHARD_COUNT, buffer_size=SHARD_BUFFER_SIZE):
+        super().__init__()
+        self.count = count
+        self._writers = [None] * count
+        self._queues = [asyncio.Queue(buffer_size) for _ in range(count)]
+        self._senders = []
+
+    async def _connect(self, index):
+        deadline = time.monotonic() + SHARD_CONNECT_TIMEOUT
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(shard_socket(index))
+                return writer
+            except OSError:
+                # Воркер ещё запускается или перезапускается
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def _send(self, index, line):
+        writer = self._writers[index]
+        if writer is None or writer.is_closing():
+            writer = self._writers[index] = await self._connect(index)
+        writer.write(line)
+        await writer.drain()
+
+    async def _sender(self, index):
+        queue = self._queues[index]
+        while True:
+            update_id, line = await queue.get()
+            try:
+                while True:
+                    try:
+                        await self._send(index, line)
+                        metrics.inc("bot_shard_updates_total", shard=index)
+                        break
+                    except OSError as e:
+                        # Соединение со старым воркером оборвалось или новый ещё не поднялся — ждём его
+                        self._writers[index] = None
+                        metrics.inc("bot_shard_errors_total", shard=index)
+                        logger.error(
+                            f"Шард {index} недоступен, апдейт {update_id} ждёт отправки "
+                            f"(в очереди {queue.qsize()}): {e}"
+                        )
+                        await asyncio.sleep(1)
+            finally:
+                queue.task_done()
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        index = shard_of(user.id if user else (chat.id if chat else 0), self.count)
+        line = event.model_dump_json(exclude_none=True, by_alias=True).encode() + b"\n"
+        try:
+            self._queues[index].put_nowait((event.update_id, line))
+        except asyncio.QueueFull:
+            metrics.inc("bot_shard_dropped_total", shard=index)
+            logger.error(f"Очередь шарда {index} переполнена, апдейт {event.update_id} отброшен")
+
+    async def start(self):
+        """Дожидается, пока все воркеры начнут принимать соединения, и запускает отправку."""
+        self._writers = list(await asyncio.gather(*(self._connect(index) for index in range(self.count))))
+        self._senders = [asyncio.create_task(self._sender(index)) for index in range(self.count)]
+
+    def collect_metrics(self):
+        for index, queue in enumerate(self._queues):
+            metrics.set("bot_shard_queue_depth", queue.qsize(), shard=index)
+
+    async def close(self, timeout=10):
+        """Досылает накопленные апдейты (не дольше ``timeout`` секунд) и закрывает соединения."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            lost = sum(queue.qsize() for queue in self._queues)
+            logger.error(f"Не удалось передать воркерам {lost} апдейтов до остановки")
+        for sender in self._senders:
+            sender.cancel()
+        for writer in self._writers:
+            if writer is not None:
+                writer.close()
+
+async def start_shard_worker(index):
+    env = dict(
+        os.environ,
+        SHARD_INDEX=str(index),
+        SHARD_COUNT=str(SHARD_COUNT),
+        SHARD_SOCKET_DIR=SHARD_SOCKET_DIR,
+        LINKS_FILE=shard_path(LINKS_FILE, index),
+        LINKS_DB=shard_path(LINKS_DB, index),
+        STATS_HISTORY_FILE=shard_path(STATS_HISTORY_FILE, index),
+        COUNTRIES_FILE=shard_path(COUNTRIES_FILE, index),
+        # Лимит VK общий для токена — делим его между воркерами
+        VK_RPS=str(VK_RPS / SHARD_COUNT),
+        VK_BURST=str(max(1, VK_BURST // SHARD_COUNT)),
+        # Общий лимит Telegram на бота тоже делим; лимит на чат — нет: у шардов разные чаты
+        OUTBOUND_RATE=str(OUTBOUND_RATE / SHARD_COUNT),
+        OUTBOUND_BURST=str(max(1, OUTBOUND_BURST // SHARD_COUNT)),
+        METRICS_PORT=str(METRICS_PORT + 1 + index) if METRICS_PORT else "0",
+    )
+    # Своя группа процессов: Ctrl+C получает только входной процесс, он и останавливает воркеров
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), env=env, start_new_session=True
+    )
+    logger.info(f"Запущен воркер шарда {index} (pid {process.pid})")
+    return process
+
+async def supervise_shards(workers, stopping):
+    """Перезапускает упавших воркеров, пока входной процесс работает."""
+    async def watch(index):
+        while True:
+            code = await workers[index].wait()
+            if stopping.is_set():
+                return
+            logger.error(f"Воркер шарда {index} завершился с кодом {code}, перезапускаем")
+            await asyncio.sleep(1)
+            workers[index] = await start_shard_worker(index)
+    await asyncio.gather(*(watch(index) for index in range(len(workers))))
+
+async def stop_shard_workers(workers, timeout=30):
+    for process in workers:
+        if process.returncode is None:
+            process.terminate()
+    for index, process in enumerate(workers):
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Воркер шарда {index} не остановился за {timeout} с, завершаем принудительно")
+            process.kill()
+            await process.wait()
+
+async def run_sharded():
+    """Входной процесс: получает апдейты (polling или webhook) и раздаёт их воркерам."""
+    logger.info(f"Шардированный режим: {SHARD_COUNT} воркеров, сокеты в {SHARD_SOCKET_DIR}")
+    split_into_shards()
+    os.makedirs(SHARD_SOCKET_DIR, exist_ok=True)
+    workers = []
+    stopping = asyncio.Event()
+    supervisor = metrics_runner = None
+    shard_router = ShardRouterMiddleware()
+    # Воркеры в своей группе процессов и сигналов входного не получают —
+    # при любой ошибке запуска останавливаем их сами, иначе они останутся сиротами
+    try:
+        for index in range(SHARD_COUNT):
+            workers.append(await start_shard_worker(index))
+        supervisor = asyncio.create_task(supervise_shards(workers, stopping))
+        metrics_runner = await start_metrics_server()
+        dp.update.outer_middleware(shard_router)
+        metrics.add_collector(shard_router.collect_metrics)
+        await shard_router.start()
+        logger.info("Все воркеры шардов готовы")
+        dp.include_router(router)  # Обработчики не вызываются, нужны для списка типов апдейтов
+        if RUN_MODE == "webhook":
+            await run_webhook(None)
+        else:
+            await run_polling()
+    finally:
+        stopping.set()
+        await shard_router.close()
+        await stop_shard_workers(workers)
+        if supervisor is not None:
+            supervisor.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+async def run_shard_worker(user_ordering):
+    """Воркер шарда: обрабатывает апдейты своих пользователей, полученные от входного процесса."""
+    path = shard_socket(SHARD_INDEX)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    async def handle_connection(reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    await dp.feed_raw_update(bot, json.loads(line))
+                except Exception as e:
+                    logger.error(f"Ошибка обработки апдейта шарда: {str(type(e).__name__)} - {str(e)[:100]}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle_connection, path)
+    logger.info(f"Воркер шарда {SHARD_INDEX + 1}/{SHARD_COUNT} слушает {path}")
+    try:
+        await wait_for_stop_signal()
+    finally:
+        server.close()
+        if user_ordering is not None:
+            await user_ordering.drain()
+        await bot.session.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
 # Запуск
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    await stop.wait()
+    logger.info("Получен сигнал остановки")
+
+async def run_polling():
+    max_attempts = 5
+    for attempt in range(max_attempts):
+        try:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logger.info(f"Webhook успешно удалён с попытки {attempt + 1}")
+            logger.info("Начинаем polling")
+            await dp.start_polling(bot, polling_timeout=20, handle_as_tasks=False)
+            break
+        except Exception as e:
+            logger.error(f"Ошибка бота (попытка {attempt + 1}/{max_attempts}): {str(type(e).__name__)} - {str(e)[:100]}")
+            if attempt < max_attempts - 1:
+                await asyncio.sleep(5)
+            else:
+                logger.error("Превышено количество попыток")
+                raise
+
+async def run_webhook(user_ordering):
+    if not WEBHOOK_BASE_URL:
+        raise ValueError("Для режима webhook нужно задать WEBHOOK_BASE_URL")
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    app = web.Application()
+    if user_ordering is not None:
+        # Дорабатываем принятые апдейты до закрытия сессии бота
+        app.on_shutdown.append(lambda _: user_ordering.drain())
+    # Telegram сразу получает 200 OK, апдейт обрабатывается в фоне
+    SimpleRequestHandler(dp, bot, handle_in_background=True, secret_token=secret).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logger.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await bot.set_webhook(f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=secret)
+        logger.info("Webhook установлен, ожидаем апдейты")
+        await wait_for_stop_signal()
+    finally:
+        # Webhook не удаляем: Telegram придержит апдейты до перезапуска
+        await runner.cleanup()
+
 async def main():
-    logger.info("Запуск бота...")
+    if SHARD_COUNT > 1 and SHARD_INDEX is None:
+        await run_sharded()
+        return
+    if SHARD_INDEX is None:
+        check_shard_count()
+    logger.info("Запуск бота..." if SHARD_INDEX is None else f"Запуск воркера шарда {SHARD_INDEX}...")
     dp.include_router(router)  # Регистрация роутера до polling
-    async with aiohttp.ClientSession() as vk_session:
-        # Регистрация middleware
-        dp.update.middleware(VKSessionMiddleware(vk_session))
-        max_attempts = 5
-        for attempt in range(max_attempts):
+    storage.start()
+    vk_stats_task = asyncio.create_task(vk_scheduler.report_loop())
+    metrics_runner = await start_metrics_server()
+    user_ordering = UserOrderingMiddleware() if UPDATE_CONCURRENCY > 1 else None
+    try:
+        async with aiohttp.ClientSession() as vk_session:
+            # Регистрация middleware: повторные нажатия отсекаются до очереди пользователя
+            dp.update.outer_middleware(flood_control.coalesce)
+            if user_ordering is not None:
+                dp.update.outer_middleware(user_ordering)
+            dp.update.middleware(VKSessionMiddleware(vk_session))
+            stats_collector.start(vk_session)
             try:
-                await bot.delete_webhook(drop_pending_updates=True)
-                logger.info(f"Webhook успешно удалён с попытки {attempt + 1}")
-                logger.info("Начинаем polling")
-                await dp.start_polling(bot, polling_timeout=20, handle_as_tasks=False)
-                break
-            except Exception as e:
-                logger.error(f"Ошибка бота (попытка {attempt + 1}/{max_attempts}): {str(type(e).__name__)} - {str(e)[:100]}")
-                if attempt < max_attempts - 1:
-                    await asyncio.sleep(5)
+                if SHARD_INDEX is not None:
+                    await run_shard_worker(user_ordering)
+                elif RUN_MODE == "webhook":
+                    await run_webhook(user_ordering)
                 else:
-                    logger.error("Превышено количество попыток")
-                    raise
+                    await run_polling()
+            finally:
+                # Дорабатываем начатые апдейты, пока сессия VK ещё открыта
+                if user_ordering is not None:
+                    await user_ordering.drain()
+                await stats_collector.close()
+    finally:
+        vk_stats_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        # Финальная запись накопленных изменений при остановке
+        await storage.close()
+        short_index.close()
+        await url_prober.close()
 
 if __name__ == "__main__":
-    import sys
     logger.info(f"Кодировка stdout: {sys.stdout.encoding}")
-    asyncio.run(main())
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        # python main.py migrate [links.json] [links.db]
+        migrate_json_to_sqlite(*sys.argv[2:4])
+    else:
+        asyncio.run(main())